@@ -0,0 +1,49 @@
+import numpy as np
+
+from utils import ppm_bounds, ppm_window
+
+# sorted-window band join over m/z and retention time. one side is
+# sorted by m/z once; the ppm window of every feature on the other side
+# is then located in it by binary search, so finding all pairs costs
+# O((n + m) log m + pairs) instead of the O(n * m) of a nested loop join
+
+CHUNK_SIZE=10000 # features per batch of windows
+
+def band_join(mz_a, rt_a, mz_b, rt_b, ppm_diff, rt_diff, relative_to='a', chunk_size=CHUNK_SIZE):
+    """find all pairs of features (a, b) within ppm_diff of each other in
+    m/z and within rt_diff in retention time. the ppm difference is
+    relative to a's m/z, i.e. 1e6 * abs(a - b) <= ppm_diff * a, or to b's,
+    i.e. abs(1e6 * (a - b) / b) <= ppm_diff, as in the corresponding SQL.
+    yields (i, j) pairs of index arrays into the a and b arrays, one pair
+    of arrays per batch"""
+    mz_a, rt_a = np.asarray(mz_a, dtype=np.float64), np.asarray(rt_a, dtype=np.float64)
+    mz_b, rt_b = np.asarray(mz_b, dtype=np.float64), np.asarray(rt_b, dtype=np.float64)
+    if not len(mz_a) or not len(mz_b):
+        return
+    order = np.argsort(mz_b, kind='mergesort')
+    sorted_mz = mz_b[order]
+    for start in range(0, len(mz_a), chunk_size):
+        i = np.arange(start, min(start + chunk_size, len(mz_a)))
+        if relative_to == 'a':
+            lo, hi = ppm_window(mz_a[i], ppm_diff)
+        else:
+            lo, hi = ppm_bounds(mz_a[i], ppm_diff)
+        left = np.searchsorted(sorted_mz, lo, side='left')
+        right = np.searchsorted(sorted_mz, hi, side='right')
+        counts = right - left
+        total = counts.sum()
+        if not total:
+            continue
+        # expand each window into candidate pairs
+        ii = np.repeat(i, counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        jj = order[np.repeat(left, counts) + offsets]
+        # exact test, evaluated the same way as in SQL
+        ma, mb = mz_a[ii], mz_b[jj]
+        if relative_to == 'a':
+            keep = 1e6 * np.abs(ma - mb) <= ppm_diff * ma
+        else:
+            keep = np.abs(1e6 * (ma - mb) / mb) <= ppm_diff
+        keep &= np.abs(rt_a[ii] - rt_b[jj]) <= rt_diff
+        if keep.any():
+            yield ii[keep], jj[keep]
@@ -0,0 +1,368 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+from jinja2 import Environment
+from sqlalchemy import select, func
+from sqlalchemy.orm import sessionmaker
+
+from engine import get_psql_engine, get_db_engine, get_sqlite_engine
+from config import get_default_config, CONFIG_CASTS
+from kuj_orm import Exp, Mtab, Db, etl, initialize_schema, default_config, avoid_name_collisions
+from kuj_orm import PPM_DIFF, RT_DIFF, WITH_MS2, EXCLUDE_CONTROLS, INT_OVER_CONTROLS, EXCLUDE_ATTRS
+from sql_templates import BENCH_WINDOW_TEMPLATE, BENCH_AVG_TEMPLATE
+from synthetic import default_spec, write_experiments, SPEC_CASTS
+from utils import asciitable, format_value, console_log
+
+import new_search
+
+# times the search and match templates against the database, and the
+# arithmetic they do with m/z, rt and intensity as numeric and as
+# floating point. run it before and after migrating a database to see
+# what the schema change does to the templates.
+# the suite (see suite) instead loads synthetic experiments and times
+# loading, searching, matching and removing them, on PostgreSQL or a
+# SQLite file, and writes a report as JSON so that runs can be compared
+
+REPEAT=3 # runs of each benchmark, of which the fastest counts
+TYPES=['numeric','double precision','real']
+
+def best_time(fn,repeat=REPEAT):
+    """fastest of repeat runs of fn, in seconds"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def consume(lines):
+    n = 0
+    for line in lines:
+        n += 1
+    return n
+
+def sample_mtabs(c,ion_mode,n):
+    """(m/z, rt) of about n metabolites spread evenly over the ids"""
+    q = select([Mtab.mz, Mtab.rt]).select_from(Mtab.__table__.join(Exp.__table__)).\
+        where(Exp.ion_mode==ion_mode)
+    total = c.execute(select([func.count()]).select_from(q.alias())).scalar()
+    step = max(total // max(n,1), 1)
+    return c.execute(q.where(Mtab.id % step == 0).order_by(Mtab.id).limit(n)).fetchall()
+
+def benchmark(engine,ion_mode,n_searches=20,n_matches=2,config=None):
+    """returns a list of dicts with the name of each benchmark, the
+    number of queries it ran, and its time"""
+    if config is None:
+        config = get_default_config()
+    ppm_diff, rt_diff = config['ppm_diff'], config['rt_diff']
+    c = engine.connect()
+    try:
+        mtabs = sample_mtabs(c,ion_mode,n_searches)
+        exps = [row[0] for row in c.execute(select([Exp.name]).where(Exp.ion_mode==ion_mode).
+                                            order_by(Exp.name).limit(n_matches))]
+        results = []
+        def run(name,n,fn):
+            seconds = best_time(fn)
+            results.append({
+                'benchmark': name,
+                'queries': n,
+                'seconds': '%.3f' % seconds,
+                'ms/query': '%.1f' % (1000 * seconds / max(n,1))
+            })
+        run('search', len(mtabs), lambda: [consume(new_search.search_csv(engine,mz,rt,ion_mode,config))
+                                           for mz, rt in mtabs])
+        run('match', len(exps), lambda: [consume(new_search.match_csv(engine,exp,ion_mode,config))
+                                         for exp in exps])
+        for sql_type in TYPES[:2]:
+            query = Environment().from_string(BENCH_WINDOW_TEMPLATE).render({'type': sql_type})
+            run('ppm/rt window, %s' % sql_type, len(mtabs),
+                lambda: [c.execute(query,mz,ppm_diff,rt,rt_diff).scalar() for mz, rt in mtabs])
+        for sql_type in TYPES:
+            query = Environment().from_string(BENCH_AVG_TEMPLATE).render({'type': sql_type})
+            run('avg(intensity), %s' % sql_type, 1, lambda: c.execute(query).fetchall())
+        return results
+    finally:
+        c.close()
+
+def percentile(times,p):
+    times = sorted(times)
+    return times[min(int(len(times) * p), len(times) - 1)]
+
+def timings(name,times,rows):
+    """summary of the run times of an operation, in seconds, and of the
+    rows it produced"""
+    return {
+        'operation': name,
+        'runs': len(times),
+        'rows': rows,
+        'total': sum(times),
+        'min': min(times) if times else None,
+        'median': percentile(times,0.5) if times else None,
+        'p90': percentile(times,0.9) if times else None,
+        'max': max(times) if times else None
+    }
+
+def timed(fn):
+    """fn's result and run time in seconds"""
+    start = time.time()
+    result = fn()
+    return result, time.time() - start
+
+def db_config(config):
+    """the kuj_orm config for Db of a shell config"""
+    d = default_config()
+    d.update({
+        PPM_DIFF: config['ppm_diff'],
+        RT_DIFF: config['rt_diff'],
+        WITH_MS2: config['with_ms2'],
+        EXCLUDE_CONTROLS: config['exclude_controls'],
+        INT_OVER_CONTROLS: config['int_over_controls'] or 0,
+        EXCLUDE_ATTRS: {}
+    })
+    return d
+
+def revision():
+    """the git revision of the code, if it is in a repository"""
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull,'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def reference_matches_as_csv(db,pairs):
+    """Db.matches_as_csv as it was before the intensity summary and bulk
+    fetching, walking every intensity of every match, for checking that
+    they give the same output"""
+    exclude_controls = db.config[EXCLUDE_CONTROLS]
+    int_over_controls = db.config[INT_OVER_CONTROLS] or 0
+    out_schema = ['mtab_exp','mtab_mz','mtab_rt','mtab_annotated','match_exp','match_mz','match_rt',
+                  'match_annotated','sample','intensity','control']
+    out_recs = []
+    n = 0
+    for m, match in pairs:
+        intensities = sorted(match.intensities, key=lambda mi: mi.id)
+        if exclude_controls and any(mi.intensity > 0 and mi.sample.control == 1 for mi in intensities):
+            continue
+        controls = [mi.intensity for mi in intensities if mi.sample.control == 1]
+        aic = (sum(controls) / len(controls) if controls else 0) * int_over_controls
+        if all(mi.intensity <= aic for mi in intensities):
+            continue
+        if any(attr.name == k and attr.value == v
+               for mi in intensities
+               for attr in mi.sample.attrs
+               for k, v in db.config[EXCLUDE_ATTRS].items()):
+            continue
+        n += 1
+        for mi in intensities:
+            if mi.intensity <= 0:
+                continue
+            out_rec = {
+                'mtab_exp': m.exp.name,
+                'mtab_mz': m.mz,
+                'mtab_rt': m.rt,
+                'mtab_annotated': m.annotated,
+                'match_exp': match.exp.name,
+                'match_mz': match.mz,
+                'match_rt': match.rt,
+                'match_annotated': match.annotated,
+                'sample': mi.sample.name,
+                'intensity': mi.intensity,
+                'control': mi.sample.control
+            }
+            for attr in sorted(mi.sample.attrs, key=lambda a: a.id):
+                attrname = avoid_name_collisions(attr.name, out_rec)
+                out_rec[attrname] = attr.value
+                if attrname not in out_schema:
+                    out_schema.append(attrname)
+            out_recs.append(out_rec)
+    lines = [','.join(out_schema)] + [','.join(map(format_value,[rec.get(k,'') for k in out_schema]))
+                                      for rec in out_recs]
+    return lines, n
+
+# configs under which matches_as_csv is checked against the reference,
+# as (exclude_controls, int_over_controls). without excluding controls,
+# a match may be kept for its control intensities alone
+CHECK_CONFIGS=[(False, 0), (False, 1), (True, 0), (True, 1)]
+
+def check_matches_as_csv(session,ion_mode,pairs,config):
+    """compare Db.matches_as_csv with reference_matches_as_csv on pairs
+    under each of CHECK_CONFIGS. returns a list of dicts"""
+    checks = []
+    for exclude_controls, ioc in CHECK_CONFIGS:
+        c = db_config(config)
+        c.update({EXCLUDE_CONTROLS: exclude_controls, INT_OVER_CONTROLS: ioc})
+        db = Db(session,ion_mode,c)
+        lines, n = db.matches_as_csv(pairs)
+        ref_lines, ref_n = reference_matches_as_csv(db,pairs)
+        checks.append({
+            'exclude_controls': exclude_controls,
+            'int_over_controls': ioc,
+            'matches': n,
+            'reference_matches': ref_n,
+            'identical': lines == ref_lines and n == ref_n
+        })
+    return checks
+
+def suite(engine,dir,spec=None,ion_mode='pos',n_searches=20,n_matches=2,config=None,log=None):
+    """generate the synthetic experiments spec describes (see
+    synthetic.default_spec) in dir, load them, and time etl, search,
+    match, Db.match_all_from, Db.matches_as_csv and Db.remove_exp on
+    them. the output of matches_as_csv is checked as well (see
+    check_matches_as_csv). experiments left over from a previous run are
+    removed first. returns the report, a dict"""
+    if spec is None:
+        spec = default_spec()
+    if config is None:
+        config = get_default_config()
+    if log is None:
+        log = lambda _: None
+    Session = sessionmaker(bind=engine)
+    results = []
+    log('generating %d experiments in %s' % (spec['experiments'], dir))
+    exps, seconds = timed(lambda: write_experiments(dir,spec))
+    results.append(timings('generate',[seconds],spec['experiments'] * spec['features']))
+    session = Session()
+    try:
+        db = Db(session,ion_mode,db_config(config))
+        for e in exps:
+            db.remove_exp(e['name'])
+    finally:
+        session.close()
+    times, n = [], 0
+    for e in exps:
+        log('loading %s' % e['name'])
+        session = Session()
+        try:
+            loaded, seconds = timed(lambda: etl(session,e['name'],os.path.join(dir,e['data']),
+                                                os.path.join(dir,e['metadata']),ion_mode))
+        finally:
+            session.close()
+        if loaded is None:
+            raise ValueError('failed to load %s' % e['name'])
+        times.append(seconds)
+        n += loaded
+    results.append(timings('etl',times,n))
+    c = engine.connect()
+    try:
+        mtabs = sample_mtabs(c,ion_mode,n_searches)
+    finally:
+        c.close()
+    def run(name,calls):
+        """time each call, which returns the number of rows it produced"""
+        log(name)
+        times, rows = [], 0
+        for call in calls:
+            n, seconds = timed(call)
+            times.append(seconds)
+            rows += n
+        results.append(timings(name,times,rows))
+    run('search',[lambda mz=mz, rt=rt: consume(new_search.search_csv(engine,mz,rt,ion_mode,config))
+                  for mz, rt in mtabs])
+    targets = [(str(k), mz, rt) for k, (mz, rt) in enumerate(mtabs)]
+    run('search_file',[lambda: consume(new_search.search_targets_csv(engine,targets,ion_mode,config))])
+    match_exps = [e['name'] for e in exps[:n_matches]]
+    run('match',[lambda exp=exp: consume(new_search.match_csv(engine,exp,ion_mode,config))
+                 for exp in match_exps])
+    session = Session()
+    try:
+        db = Db(session,ion_mode,db_config(config))
+        pairs = {}
+        def match_all_from(exp):
+            pairs[exp] = list(db.match_all_from(exp))
+            return len(pairs[exp])
+        run('match_all_from',[lambda exp=exp: match_all_from(exp) for exp in match_exps])
+        run('matches_as_csv',[lambda exp=exp: len(db.matches_as_csv(pairs[exp])[0])
+                              for exp in match_exps])
+        log('checking matches_as_csv')
+        checks = [dict(check, exp=exp) for exp in match_exps
+                  for check in check_matches_as_csv(session,ion_mode,pairs[exp],config)]
+        run('remove',[lambda e=e: sum(n for _, n in db.remove_exp(e['name'])) for e in exps])
+    finally:
+        session.close()
+    return {
+        'revision': revision(),
+        'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'database': engine.dialect.name,
+        'ion_mode': ion_mode,
+        'spec': spec,
+        'config': config,
+        'searches': len(mtabs),
+        'matches': len(match_exps),
+        'results': results,
+        'checks': checks
+    }
+
+def suite_args(args):
+    """parse the args of python benchmark.py suite [report file]
+    [name=value ...]. names are those of synthetic.default_spec and
+    config.get_default_config, and dir (for the generated files, which
+    are kept if given), sqlite (a SQLite file to create and use instead
+    of DATABASE_URL), searches, matches and ion_mode. returns the report
+    file, spec, config and the other options"""
+    report_path = args[0]
+    spec, config = default_spec(), get_default_config()
+    options = dict(dir=None, sqlite=None, searches=20, matches=2, ion_mode='pos')
+    for arg in args[1:]:
+        k, v = arg.split('=',1)
+        if k in SPEC_CASTS:
+            spec[k] = SPEC_CASTS[k](v)
+        elif k in CONFIG_CASTS:
+            config[k] = CONFIG_CASTS[k](v)
+        elif k in ['searches','matches']:
+            options[k] = int(v)
+        elif k in options:
+            options[k] = v
+        else:
+            raise ValueError('unknown option %s' % k)
+    return report_path, spec, config, options
+
+def run_suite(report_path,spec,config,options):
+    if options['sqlite']:
+        engine = get_sqlite_engine(delete=True, path=options['sqlite'])
+    else:
+        engine = get_db_engine()
+    initialize_schema(engine)
+    dir = options['dir'] or tempfile.mkdtemp(prefix='domdb_bench_')
+    try:
+        report = suite(engine,dir,spec,options['ion_mode'],options['searches'],options['matches'],config,log=console_log)
+    finally:
+        if not options['dir']:
+            shutil.rmtree(dir)
+    with open(report_path,'w') as f:
+        json.dump(report,f,indent=2,sort_keys=True)
+    rows = [dict((k, '%.3f' % v if isinstance(v, float) else v) for k, v in r.items())
+            for r in report['results']]
+    for line in asciitable(rows,['operation','runs','rows','total','min','median','p90','max']):
+        print line
+    for line in asciitable(report['checks'],['exp','exclude_controls','int_over_controls','matches',
+                                             'reference_matches','identical']):
+        print line
+    print 'report written to %s' % report_path
+
+if __name__=='__main__':
+    if sys.argv[1:2] == ['suite']:
+        try:
+            args = suite_args(sys.argv[2:])
+        except (IndexError, ValueError) as e:
+            print 'Usage: python benchmark.py suite [report file] [name=value ...]'
+            sys.exit(-1)
+        run_suite(*args)
+        sys.exit(0)
+    try:
+        ion_mode = sys.argv[1]
+        n_searches = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+        n_matches = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    except (IndexError, ValueError):
+        print 'Usage: python benchmark.py [ion mode] [number of searches] [number of matches]'
+        sys.exit(-1)
+    results = benchmark(get_psql_engine(),ion_mode,n_searches,n_matches)
+    for line in asciitable(results,['benchmark','queries','seconds','ms/query']):
+        print line
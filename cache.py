@@ -0,0 +1,108 @@
+import os
+import glob
+import hashlib
+import threading
+from collections import OrderedDict
+
+# results of searches and matches as CSV lines, by query. entries are
+# kept in memory up to a total size, least recently used out first,
+# and optionally in a directory as well, where they outlast the shell.
+# every entry belongs to a data generation (see kuj_orm.data_generation)
+# and is never used once the generation has changed, i.e. after
+# experiments have been added or removed
+
+class ResultCache(object):
+    def __init__(self, size, dir=None):
+        """size is the most bytes of lines to keep in memory, dir is a
+        directory to keep results in as well, or None"""
+        self.size = size
+        self.dir = dir
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key to (lines, bytes)
+        self._used = 0
+        self._generation = None
+        if dir is not None and not os.path.exists(dir):
+            os.makedirs(dir)
+    def _path(self, key, generation):
+        digest = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.dir, '%d_%s.csv' % (generation, digest))
+    def _expire(self, generation):
+        """forget entries of other generations. call with the lock held"""
+        if generation == self._generation:
+            return
+        self._entries.clear()
+        self._used = 0
+        self._generation = generation
+        if self.dir is not None:
+            for path in glob.glob(os.path.join(self.dir, '*_*.csv')):
+                if not os.path.basename(path).startswith('%d_' % generation):
+                    try:
+                        os.remove(path)
+                    except OSError: # another shell removed it
+                        pass
+    def get(self, key, generation):
+        """the lines of an entry, or None if there is none"""
+        with self._lock:
+            self._expire(generation)
+            if key in self._entries:
+                entry = self._entries.pop(key)
+                self._entries[key] = entry # now the most recently used
+                return entry[0]
+        if self.dir is not None:
+            try:
+                f = open(self._path(key, generation))
+            except IOError:
+                return None
+            return read_lines(f)
+        return None
+    def writer(self, key, generation):
+        return CacheWriter(self, key, generation)
+    def _put(self, key, generation, lines, n_bytes):
+        with self._lock:
+            self._expire(generation)
+            if key in self._entries:
+                self._used -= self._entries.pop(key)[1]
+            while self._entries and self._used + n_bytes > self.size:
+                self._used -= self._entries.popitem(last=False)[1][1]
+            self._entries[key] = (lines, n_bytes)
+            self._used += n_bytes
+
+def read_lines(f):
+    with f:
+        for line in f:
+            yield line.decode('utf-8').rstrip('\n')
+
+class CacheWriter(object):
+    """adds the lines of a result to the cache as they are produced.
+    the entry is only added if the result is complete. lines are kept
+    in memory only while they fit"""
+    def __init__(self, cache, key, generation):
+        self.cache = cache
+        self.key = key
+        self.generation = generation
+        self.lines = []
+        self.bytes = 0
+        self.f = None
+        if cache.dir is not None:
+            self.path = cache._path(key, generation)
+            self.tmp = '%s.%d.%d.tmp' % (self.path, os.getpid(), id(self))
+            self.f = open(self.tmp, 'w')
+    def add(self, line):
+        self.bytes += len(line)
+        if self.lines is not None:
+            if self.bytes <= self.cache.size:
+                self.lines.append(line)
+            else:
+                self.lines = None
+        if self.f is not None:
+            self.f.write(line.encode('utf-8') + '\n')
+    def commit(self):
+        if self.f is not None:
+            self.f.close()
+            os.rename(self.tmp, self.path)
+        if self.lines is not None:
+            self.cache._put(self.key, self.generation, self.lines, self.bytes)
+    def abort(self):
+        if self.f is not None:
+            self.f.close()
+            os.remove(self.tmp)
@@ -0,0 +1,85 @@
+import threading
+
+from kuj_orm import Exp, Sample, SampleAttr, Db
+
+# names the shell completes and lists, cached so that pressing TAB does
+# not query the database. the cache is loaded on first use and dropped
+# whenever the shell adds or removes data. the samples of an experiment
+# are loaded the first time they are listed
+
+def load_samples(session, exp_name, ion_mode):
+    """the samples of an experiment as (columns, rows), rows being dicts
+    of name, control and sample attributes, for listing. None if there
+    is no such experiment"""
+    cols = ['name','control']
+    rows = []
+    # one row per sample attribute, all in one query. an experiment with
+    # no samples has a single row of nulls
+    q = session.query(Sample.id, Sample.name, Sample.control, SampleAttr.name, SampleAttr.value).\
+        select_from(Exp).\
+        outerjoin(Sample, Sample.exp_id==Exp.id).\
+        outerjoin(SampleAttr, SampleAttr.sample_id==Sample.id).\
+        filter(Exp.name==exp_name).filter(Exp.ion_mode==ion_mode).\
+        order_by(Sample.id, SampleAttr.name).all()
+    if not q:
+        return None
+    d = None
+    for sample_id, name, control, attr_name, attr_value in q:
+        if sample_id is None:
+            continue
+        if d is None or d['id'] != sample_id:
+            d = { 'id': sample_id,
+                  'name': name,
+                  'control': control }
+            rows.append(d)
+        if attr_name is None or attr_name=='ignore':
+            continue
+        if attr_name not in cols:
+            cols.append(attr_name)
+        d[attr_name] = attr_value
+    return cols, rows
+
+class Catalog(object):
+    def __init__(self, session_factory, ion_mode):
+        self.session_factory = session_factory
+        self.ion_mode = ion_mode
+        self._lock = threading.Lock()
+        self._exps = None
+        self._attrs = None
+        self._samples = {}
+    def invalidate(self):
+        with self._lock:
+            self._exps = None
+            self._attrs = None
+            self._samples = {}
+    def _load(self):
+        with self._lock:
+            if self._exps is not None:
+                return self._exps, self._attrs
+            session = self.session_factory()
+            try:
+                exps = sorted(r[0] for r in session.query(Exp.name).filter(Exp.ion_mode==self.ion_mode))
+                attrs = Db(session, self.ion_mode).all_attrs()
+            finally:
+                session.close()
+            self._exps, self._attrs = exps, attrs
+            return exps, attrs
+    def exp_names(self, prefix=''):
+        return [name for name in self._load()[0] if name.startswith(prefix)]
+    def attr_names(self, prefix=''):
+        return sorted(name for name in self._load()[1] if name.startswith(prefix))
+    def attrs(self):
+        """sample attribute names and their values, as Db.all_attrs"""
+        return self._load()[1]
+    def samples(self, exp_name):
+        """the samples of an experiment, as load_samples"""
+        if exp_name not in self._load()[0]:
+            return None
+        with self._lock:
+            if exp_name not in self._samples:
+                session = self.session_factory()
+                try:
+                    self._samples[exp_name] = load_samples(session, exp_name, self.ion_mode)
+                finally:
+                    session.close()
+            return self._samples[exp_name]
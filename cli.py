@@ -3,33 +3,70 @@ import sys
 import cmd
 import glob
 import re
+import time
+import multiprocessing
 
-from sqlalchemy import func
+import sqlalchemy
+from sqlalchemy.sql.functions import coalesce
 from sqlalchemy.orm import sessionmaker
 
 from config import complete_config_key, set_config_key, initialize_config, save_config, get_default_config
-from kuj_orm import Base, Exp, Mtab, DomDb, etl, initialize_schema, SampleAttr
+from config import SEARCH_TIMEOUT, MATCH_TIMEOUT, LOAD_TIMEOUT, REMOVE_TIMEOUT, SNAPSHOT_DIR, CACHE_SIZE, CACHE_DIR, QUERY_LOG
+from config import PPM_DIFF, RT_DIFF, WITH_MS2, EXCLUDE_CONTROLS, INT_OVER_CONTROLS, ATTRS
+from kuj_orm import Base, Exp, ExpStats, DomDb, etl, initialize_schema
+from kuj_orm import partition_intensities, pack_intensities, PARTITIONED, PACKED
 from complete_path import complete_path
-from utils import asciitable
+from catalog import Catalog
+from utils import asciitable, console_log
+from snapshot import export_snapshot, open_snapshot
+from cache import ResultCache
+from profiling import Profile, QueryLog
 
 import new_search
+import jobs
 
-from engine import get_psql_engine
+from engine import get_db_engine
 
 DEBUG=False
 # ORM session management
 
-def console_log(o):
-    """so I can mix old and new-style print functions"""
-    print str(o)
+def job_log(o):
+    """console_log that records progress of the current job, and only
+    prints if the job is in the foreground"""
+    jobs.progress(message=str(o))
+    job = jobs.current_job()
+    if job is None or not job.background:
+        console_log(o)
+
+# commands that run as jobs, with their statement timeout config keys
+JOB_TIMEOUTS = {
+    'search': SEARCH_TIMEOUT,
+    'search_file': SEARCH_TIMEOUT,
+    'match': MATCH_TIMEOUT,
+    'add': LOAD_TIMEOUT,
+    'add_dir': LOAD_TIMEOUT,
+    'remove': REMOVE_TIMEOUT,
+    'partition': LOAD_TIMEOUT,
+    'pack': LOAD_TIMEOUT,
+    'export_snapshot': LOAD_TIMEOUT
+}
+
+# commands after which the catalog has to be reloaded
+CHANGES_DATA = ['add', 'add_dir', 'remove']
+
+_engine = None
 
 def get_engine():
-    if DEBUG:
-        engine = sqlalchemy.create_engine('sqlite://')
-    else:
-        #engine = get_sqlite_engine(delete=False)
-        engine = get_psql_engine()
-    return engine
+    """the process-wide engine, created on first use. commands share
+    its connection pool instead of connecting each time"""
+    global _engine
+    if _engine is None:
+        if DEBUG:
+            _engine = sqlalchemy.create_engine('sqlite://')
+        else:
+            _engine = get_db_engine()
+        jobs.install(_engine)
+    return _engine
 
 def get_session_factory():
     engine = get_engine()
@@ -40,14 +77,15 @@ def get_session_factory():
 def list_exps(session,ion_mode):
     # list experiments, and stats about them
     def q():
-        # for all experiments
-        for exp in session.query(Exp).filter(Exp.ion_mode==ion_mode).all():
-            n_samples = len(exp.samples) # count the samples
-            # count the metabolites
-            n_mtabs = session.query(func.count(Mtab.id)).filter(Mtab.exp==exp).first()[0]
-            # return a row
+        # counts are kept in exp_stats as experiments are added
+        for name, n_samples, n_mtabs in session.query(Exp.name,
+                                                      coalesce(ExpStats.samples,0),
+                                                      coalesce(ExpStats.metabolites,0)).\
+            outerjoin(ExpStats, ExpStats.exp_id==Exp.id).\
+            filter(Exp.ion_mode==ion_mode).\
+            order_by(Exp.name):
             yield {
-                'name': exp.name,
+                'name': name,
                 'samples': n_samples,
                 'metabolites': n_mtabs
             }
@@ -55,23 +93,12 @@ def list_exps(session,ion_mode):
     for line in asciitable(list(q()),['name','samples','metabolites'],'Database is empty'):
         print line
 
-def list_samples(session,exp_name,ion_mode):
-    cols = ['name','control']
-    rows = []
-    exp = session.query(Exp).filter(Exp.name==exp_name).filter(Exp.ion_mode==ion_mode).first()
-    if exp is None:
+def list_samples(catalog,exp_name):
+    samples = catalog.samples(exp_name)
+    if samples is None:
         print 'No such experiment %s' % exp_name
         return
-    for sample in exp.samples:
-        d = { 'name': sample.name,
-              'control': sample.control }
-        for a in sorted(sample.attrs,key=lambda a:a.name):
-            if a.name=='ignore':
-                continue
-            if a.name not in cols:
-                cols.append(a.name)
-            d[a.name] = a.value
-        rows.append(d)
+    cols, rows = samples
     for line in asciitable(rows,cols,'No samples found'):
         print line
 
@@ -100,6 +127,41 @@ def list_exp_files(dir):
                 'metadata': os.path.basename(v['metadata'])
                 }
 
+def load_exp(task, session_factory=None, echo=False):
+    """load one experiment for add_dir. runs in its own session (and, in a
+    worker process, its own engine) so that a failure only rolls back
+    that experiment. returns a summary dict"""
+    name, path, mdpath, ion_mode, timeout = task
+    if session_factory is None:
+        session_factory = get_session_factory()
+    messages = []
+    def log(msg):
+        messages.append(msg)
+        if echo:
+            job_log('%s: %s' % (name, msg))
+    start = time.time()
+    session = session_factory()
+    try:
+        log('loading from %s and %s' % (path, mdpath))
+        with jobs.statement_timeout(timeout):
+            n = etl(session,name,path,mdpath,ion_mode,log=log)
+        status = 'loaded' if n is not None else 'failed'
+        errors = [m for m in messages if m.startswith('ERROR')]
+        message = (errors or messages)[-1]
+    except Exception as e:
+        session.rollback()
+        n, status, message = None, 'failed', 'ERROR: %s' % str(e).strip().split('\n')[0]
+        log(message)
+    finally:
+        session.close()
+    return {
+        'name': name,
+        'status': status,
+        'metabolites': n if n is not None else 0,
+        'seconds': '%.1f' % (time.time() - start),
+        'message': message
+    }
+
 class Shell(cmd.Cmd):
     def __init__(self,session_factory,ion_mode):
         cmd.Cmd.__init__(self)
@@ -107,7 +169,79 @@ class Shell(cmd.Cmd):
         self.session_factory = session_factory
         self.config = initialize_config()
         self.ion_mode = ion_mode
+        self.jobs = jobs.Jobs()
+        self.catalog = Catalog(session_factory, ion_mode)
+        self._cache = None
+        # whether to print and log the time searches and matches take,
+        # and whether to capture their plans
+        self.timing = False
+        self.explain = False
+        self.last_profile = None
         self.do_count('')
+    def onecmd(self,line):
+        """run long commands as jobs, in the background if the line ends
+        with &. otherwise wait for them, so that Ctrl-C cancels the job
+        instead of exiting"""
+        line = line.strip()
+        background = line.endswith('&')
+        if background:
+            line = line[:-1].strip()
+        command = self.parseline(line)[0]
+        if command not in JOB_TIMEOUTS:
+            if background:
+                print 'only %s can run in the background' % ', '.join(sorted(JOB_TIMEOUTS))
+            return cmd.Cmd.onecmd(self,line)
+        self.lastcmd = line
+        timeout = self.config.get(JOB_TIMEOUTS[command])
+        def run():
+            try:
+                cmd.Cmd.onecmd(self,line)
+            finally:
+                if command in CHANGES_DATA:
+                    self.catalog.invalidate()
+        job = self.jobs.submit(line, run, timeout, background)
+        if background:
+            print '[%d] %s' % (job.id, line)
+        else:
+            self._wait(job)
+    def postcmd(self,stop,line):
+        # report background jobs that have finished since the last command
+        for job in self.jobs.finished_unreported():
+            self._report(job)
+        return stop
+    def _wait(self,job):
+        jobs.wait(job, console_log)
+        if job.status != jobs.DONE:
+            self._report(job)
+    def _report(self,job):
+        print '[%d] %s: %s (%s, %.1f seconds)' % (job.id, job.status, job.command, job.describe(), job.elapsed())
+    def do_jobs(self,args):
+        rows = [{
+            'id': job.id,
+            'command': job.command,
+            'status': job.status,
+            'progress': job.describe(),
+            'seconds': '%.1f' % job.elapsed()
+        } for job in self.jobs.jobs]
+        for line in asciitable(rows,['id','command','status','progress','seconds'],'No jobs'):
+            print line
+    def _job_arg(self,args):
+        try:
+            job = self.jobs.get(int(args) if args.strip() else None)
+        except ValueError:
+            job = None
+        if job is None:
+            print 'No such job %s' % args
+        return job
+    def do_wait(self,args):
+        job = self._job_arg(args)
+        if job is not None:
+            self._wait(job)
+    def do_cancel(self,args):
+        job = self._job_arg(args)
+        if job is not None and job.alive():
+            job.cancel()
+            print '[%d] cancelling' % job.id
     def do_count(self,args):
         with DomDb(self.session_factory, self.ion_mode, self.config) as domdb:
             if not args:
@@ -117,6 +251,30 @@ class Shell(cmd.Cmd):
                 exp = args.split(' ')[0]
                 n = domdb.mtab_count(exp)
                 print '%d metabolites in experiment %s' % (n, exp)
+    def do_density(self,args):
+        """density [n]: how many metabolites fall within the configured
+        ppm/rt window of each metabolite, counting itself, by ion mode
+        and experiment. with n, estimated from n random metabolites"""
+        try:
+            n = int(args) if args.strip() else None
+        except ValueError:
+            print 'usage: density [number of metabolites to sample]'
+            return
+        with DomDb(self.session_factory, self.ion_mode, self.config) as domdb:
+            rows = []
+            for (ion_mode, exp), pdf in sorted(domdb.match_density(n).items()):
+                total = sum(pdf.values())
+                rows.append({
+                    'ion_mode': ion_mode,
+                    'exp': exp,
+                    'metabolites': total,
+                    'unmatched': pdf.get(1, 0),
+                    'mean': '%.2f' % (sum(n_ms * c for n_ms, c in pdf.items()) / float(total)),
+                    'max': max(pdf),
+                    'distribution': ' '.join('%d:%d' % kv for kv in sorted(pdf.items()))
+                })
+            for line in asciitable(rows,['ion_mode','exp','metabolites','unmatched','mean','max','distribution'],'No metabolites'):
+                print line
     def do_list(self,args):
         session = self.session_factory()
         list_exps(session, self.ion_mode)
@@ -130,20 +288,59 @@ class Shell(cmd.Cmd):
     def complete_dir(self, text, line, start_idx, end_idx):
         return complete_path(text, line)
     def do_add_dir(self, args):
-        dir = args
+        try:
+            arglist = re.split(r' +',args.strip())
+            dir = arglist[0]
+            workers = int(arglist[1]) if len(arglist) > 1 else 1
+        except ValueError:
+            print 'usage: add_dir [dir] [number of parallel workers]'
+            return
         result = list(list_exp_files(dir))
         print 'found files for %d experiments in %s' % (len(result), dir)
+        timeout = self.config.get(LOAD_TIMEOUT)
+        tasks = [(d['name'], os.path.join(dir,d['data']), os.path.join(dir,d['metadata']), self.ion_mode, timeout)
+                 for d in result]
+        if workers > 1 and get_engine().dialect.name == 'sqlite':
+            # etl holds SQLite's only write lock for a whole experiment,
+            # so parallel workers would just wait for each other
+            print 'SQLite loads one experiment at a time, ignoring %d workers' % workers
+            workers = 1
+        start = time.time()
+        if workers > 1 and len(tasks) > 1:
+            print 'loading with %d parallel workers' % workers
+            # pooled connections must not be shared with forked workers,
+            # which open their own from the (now empty) pool
+            get_engine().dispose()
+            pool = multiprocessing.Pool(min(workers, len(tasks)))
+            results = []
+            try:
+                it = pool.imap_unordered(load_exp, tasks)
+                while len(results) < len(tasks):
+                    try:
+                        r = it.next(1)
+                    except multiprocessing.TimeoutError:
+                        jobs.progress() # stops here if cancelled
+                        continue
+                    job_log('%s: %s (%s)' % (r['name'], r['status'], r['message']))
+                    results.append(r)
+                pool.close()
+            finally:
+                # terminating workers rolls back what they were loading
+                pool.terminate()
+                pool.join()
+        else:
+            results = []
+            for task in tasks:
+                jobs.progress() # stops here if cancelled
+                results.append(load_exp(task, self.session_factory, echo=True))
+        for line in asciitable(sorted(results,key=lambda r: r['name']),
+                               ['name','status','metabolites','seconds','message'],'No experiments loaded'):
+            print line
+        n_ok = len([r for r in results if r['status']=='loaded'])
+        print '%d of %d experiments loaded in %.1f seconds' % (n_ok, len(results), time.time() - start)
         with DomDb(self.session_factory, self.ion_mode, self.config) as domdb:
-            for d in result:
-                name = d['name']
-                path = os.path.join(dir,d['data'])
-                mdpath = os.path.join(dir,d['metadata'])
-                print 'loading experiment %s from:' % name
-                print '- data file %s' % path
-                print '- metadata file %s' % mdpath
-                etl(domdb.session,name,path,mdpath,self.ion_mode,log=console_log)
-                n = domdb.mtab_count(self.ion_mode)
-                print '%d metabolites in database' % n
+            n = domdb.mtab_count()
+            print '%d metabolites in database' % n
     def complete_add_dir(self, text, line, start_idx, end_idx):
         return complete_path(text, line)
     def do_add(self,args):
@@ -162,17 +359,17 @@ class Shell(cmd.Cmd):
         print 'data file %s' % path
         print 'metadata file %s' % mdpath
         session = self.session_factory()
-        etl(session,exp,path,mdpath,self.ion_mode,log=console_log)
-        session.close()
+        try:
+            etl(session,exp,path,mdpath,self.ion_mode,log=job_log)
+        finally:
+            session.close()
         with DomDb(self.session_factory, self.ion_mode, self.config) as domdb:
             n = domdb.mtab_count()
         print '%d metabolites in database' % n
     def complete_add(self, text, line, start_idx, end_idx):
         return complete_path(text, line)
     def complete_remove(self, text, line, start_idx, end_idx):
-        session = self.session_factory()
-        exps = session.query(Exp).filter(Exp.ion_mode==self.ion_mode).filter(Exp.name.like(text+'%')).all()
-        return [e.name for e in exps]
+        return self.catalog.exp_names(text)
     def do_remove(self,args):
         try:
             exp = args.split(' ')[0]
@@ -180,15 +377,155 @@ class Shell(cmd.Cmd):
             print 'ERROR: remove takes [exp name]'
             return
         print 'Removing all %s data ...' % exp
+        start = time.time()
         with DomDb(self.session_factory, self.ion_mode, self.config) as domdb:
-            domdb.remove_exp(exp)
+            counts = domdb.remove_exp(exp)
+            if counts is None:
+                print 'No such experiment %s' % exp
+                return
+            for line in asciitable([dict(table=t, rows=n) for t, n in counts],['table','rows']):
+                print line
+            print 'removed %s in %.1f seconds' % (exp, time.time() - start)
         self.do_list('')
+    def do_partition(self,args):
+        """convert the intensity table to one partitioned by experiment"""
+        print 'Partitioning intensities by experiment ...'
+        start = time.time()
+        n = partition_intensities(get_engine(), log=job_log)
+        if n is None:
+            print 'intensities are already partitioned'
+            return
+        print 'created %d partitions in %.1f seconds' % (n, time.time() - start)
+    def do_pack(self,args):
+        """convert the intensity table to packed intensities"""
+        print 'Packing intensities ...'
+        start = time.time()
+        n = pack_intensities(get_engine(), log=job_log)
+        if n is None:
+            print 'intensities are already packed'
+            return
+        print 'packed %d experiments in %.1f seconds' % (n, time.time() - start)
+    def do_export_snapshot(self,args):
+        """write a snapshot of the metabolites for searching, to the given
+        directory or the configured one"""
+        dir = args.strip() or self.config.get(SNAPSHOT_DIR)
+        if not dir:
+            print 'usage: export_snapshot [dir]'
+            return
+        print 'Exporting %s metabolites to %s ...' % (self.ion_mode, dir)
+        start = time.time()
+        n = export_snapshot(get_engine(), dir, self.ion_mode, log=job_log)
+        print 'exported %d metabolites in %.1f seconds' % (n, time.time() - start)
+        if self.config.get(SNAPSHOT_DIR) != dir:
+            # searches use it from now on
+            set_config_key(self.config, SNAPSHOT_DIR, dir)
+            save_config(self.config)
+            print 'set %s to %s' % (SNAPSHOT_DIR, dir)
+    def complete_export_snapshot(self, text, line, start_idx, end_idx):
+        return complete_path(text, line)
+    def _snapshot(self):
+        """the configured snapshot, if it is current. otherwise searches
+        find the metabolites in the database"""
+        dir = self.config.get(SNAPSHOT_DIR)
+        if not dir:
+            return None
+        snapshot = open_snapshot(dir, self.ion_mode)
+        if snapshot is None:
+            print 'no %s snapshot in %s, searching the database' % (self.ion_mode, dir)
+            return None
+        c = get_engine().connect()
+        try:
+            current = snapshot.is_current(c)
+        finally:
+            c.close()
+        if not current:
+            print 'snapshot in %s is out of date, searching the database. run export_snapshot to update it' % dir
+            return None
+        return snapshot
+    def _result_cache(self):
+        """the ResultCache for the configured size and directory"""
+        size = self.config.get(CACHE_SIZE) * 1024 * 1024
+        dir = self.config.get(CACHE_DIR)
+        if self._cache is None or (self._cache.size, self._cache.dir) != (size, dir):
+            self._cache = ResultCache(size, dir)
+        return self._cache
+    def do_timing(self,args):
+        """timing on|off: print how long each phase of searches and
+        matches takes, and log it to the query log"""
+        if args.strip() in ['on','off']:
+            self.timing = args.strip() == 'on'
+        elif args.strip():
+            print 'usage: timing on|off'
+            return
+        print 'timing is %s' % ('on' if self.timing else 'off')
+    def do_explain(self,args):
+        """explain on|off: capture the plans of searches and matches. on
+        PostgreSQL this runs each query twice. with no args, print the
+        plan of the last search or match"""
+        if args.strip() in ['on','off']:
+            self.explain = args.strip() == 'on'
+            print 'explain is %s' % ('on' if self.explain else 'off')
+        elif args.strip():
+            print 'usage: explain [on|off]'
+        elif self.last_profile is None or self.last_profile.plan is None:
+            print 'no plan captured. use explain on, then search or match'
+        else:
+            for line in self.last_profile.plan:
+                print line
+    def do_slowest(self,args):
+        """slowest [n]: the n slowest queries in the query log"""
+        try:
+            n = int(args) if args.strip() else 10
+        except ValueError:
+            print 'usage: slowest [number of queries]'
+            return
+        path = self.config.get(QUERY_LOG)
+        if not path:
+            print 'no query log. set %s to a file' % QUERY_LOG
+            return
+        rows = [{
+            'time': r['time'],
+            'command': r['command'],
+            'seconds': '%.3f' % r['seconds'],
+            'rows': r['rows'],
+            'phases': ', '.join('%s %.3f' % (k, v) for k, v in sorted(r['phases'].items(), key=lambda kv: -kv[1]))
+        } for r in QueryLog(path).slowest(n)]
+        for line in asciitable(rows,['time','command','seconds','rows','phases'],'No queries logged'):
+            print line
+    def _profile(self):
+        """a Profile for the next search or match, if it is wanted"""
+        if self.timing or self.explain:
+            return Profile(explain=self.explain)
+    def _report_profile(self,command,profile,seconds):
+        """print and log the profile of a search or match"""
+        if profile is None:
+            return
+        self.last_profile = profile
+        if self.timing:
+            print '%d rows in %.3f seconds (%s, write %.3f)' % (profile.rows, seconds, profile.describe(),
+                                                              seconds - sum(profile.phases.values()))
+        if profile.plan is not None:
+            for line in profile.plan:
+                print line
+        path = self.config.get(QUERY_LOG)
+        if path:
+            record = {
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'command': command,
+                'ion_mode': self.ion_mode,
+                'database': get_engine().dialect.name,
+                'config': dict((k, self.config.get(k)) for k in
+                               [PPM_DIFF, RT_DIFF, WITH_MS2, EXCLUDE_CONTROLS, INT_OVER_CONTROLS, ATTRS]),
+                'seconds': seconds,
+                'rows': profile.rows,
+                'phases': profile.phases
+            }
+            if profile.plan is not None:
+                record['query'] = profile.query
+                record['plan'] = profile.plan
+            QueryLog(path).append(record)
     def _complete_attr(self, text):
-        session = self.session_factory()
-        return [r[0] for r in session.query(SampleAttr.name).\
-                filter(SampleAttr.name.like(text+'%')).\
-                order_by(SampleAttr.name).\
-                distinct().all()]
+        return self.catalog.attr_names(text)
     def complete_set(self, text, line, start_idx, end_idx):
         if re.match(r'.*attrs.*',line):
             return self._complete_attr(text)
@@ -197,6 +534,8 @@ class Shell(cmd.Cmd):
         def massage(key,value):
             if key == 'attrs' and not value:
                 return '(any)'
+            if isinstance(value, basestring): # paths
+                return value
             try:
                 return ','.join(value)
             except:
@@ -232,29 +571,21 @@ class Shell(cmd.Cmd):
         save_config(self.config)
         self._print_config()
     def complete_samples(self, text, line, start_idx, end_idx):
-        session = self.session_factory()
-        return [r[0] for r in session.query(Exp.name).\
-                filter(Exp.ion_mode==self.ion_mode).\
-                filter(Exp.name.like(text+'%')).\
-                order_by(Exp.name).\
-                distinct().all()]
+        return self.catalog.exp_names(text)
     def do_samples(self, args):
         exp_name = args
         if not exp_name:
             print 'Usage: samples [experiment name]'
             return
-        session = self.session_factory()
-        list_samples(session,exp_name,self.ion_mode)
-        session.close()
+        list_samples(self.catalog,exp_name)
     def do_list_attrs(self,args):
-        with DomDb(self.session_factory, self.ion_mode, self.config) as domdb:
-            aa = domdb.all_attrs()
-            def table():
-                for k,v in aa.items():
-                    if k not in ['ignore']:
-                        yield {'name':k, 'values': ','.join(v)}
-            for line in asciitable(table(),disp_cols=['name','values']):
-                print line
+        aa = self.catalog.attrs()
+        def table():
+            for k,v in aa.items():
+                if k not in ['ignore']:
+                    yield {'name':k, 'values': ','.join(v)}
+        for line in asciitable(table(),disp_cols=['name','values']):
+            print line
     def do_exit(self,args):
         sys.exit(0)
     def do_quit(self,args):
@@ -263,6 +594,11 @@ class Shell(cmd.Cmd):
         yield '"# ion_mode=%s"' % self.ion_mode
         for d in self._render_config():
             yield '"# %s=%s"' % (d['var'], str(d['value']))
+    def _export(self,fout,lines):
+        # the first line is the header
+        for n, line in enumerate(lines):
+            print >>fout, line
+            jobs.progress(rows=n)
     def do_search(self,args):
         try:
             arglist = re.split(r' +',args)
@@ -272,12 +608,40 @@ class Shell(cmd.Cmd):
         except IndexError:
             print 'usage: search [mz] [rt] [outfile]'
             return
+        profile = self._profile()
+        start = time.time()
         with open(outf,'w') as fout:
-            r = new_search.search(get_engine(),mz,rt,self.ion_mode,self.config)
             for line in self._dump_config():
                 print >>fout, line
-            for line in new_search.results_as_csv(r):
+            self._export(fout, new_search.search_csv(get_engine(),mz,rt,self.ion_mode,self.config,self._snapshot(),self._result_cache(),profile=profile))
+        self._report_profile('search %s' % args, profile, time.time() - start)
+    def do_search_file(self,args):
+        try:
+            arglist = re.split(r' +',args)
+            inf = arglist[0]
+            outf = arglist[1]
+        except IndexError:
+            print 'usage: search_file [targets file] [outfile]'
+            return
+        try:
+            targets = new_search.read_targets(inf)
+        except (IOError, KeyError, ValueError) as e:
+            print 'ERROR: cannot read targets from %s: %s' % (inf, e)
+            print 'targets file must be a CSV file with mz, rt, and (optionally) id columns'
+            return
+        if not targets:
+            print 'no targets found in %s' % inf
+            return
+        print 'searching for %d targets' % len(targets)
+        profile = self._profile()
+        start = time.time()
+        with open(outf,'w') as fout:
+            for line in self._dump_config():
                 print >>fout, line
+            self._export(fout, new_search.search_targets_csv(get_engine(),targets,self.ion_mode,self.config,self._result_cache(),profile=profile))
+        self._report_profile('search_file %s' % args, profile, time.time() - start)
+    def complete_search_file(self, text, line, start_idx, end_idx):
+        return complete_path(text, line)
     def do_match(self,args):
         try:
             arglist = re.split(r' +',args)
@@ -286,12 +650,13 @@ class Shell(cmd.Cmd):
         except IndexError:
             print 'usage: match [exp_name] [outfile]'
             return
+        profile = self._profile()
+        start = time.time()
         with open(outf,'w') as fout:
-            r = new_search.match(get_engine(),exp_name,self.ion_mode,self.config)
             for line in self._dump_config():
                 print >>fout, line
-            for line in new_search.results_as_csv(r):
-                print >>fout, line
+            self._export(fout, new_search.match_csv(get_engine(),exp_name,self.ion_mode,self.config,self._result_cache(),profile=profile))
+        self._report_profile('match %s' % args, profile, time.time() - start)
 
 def get_ion_mode(s):
     if s in ['neg','pos']:
@@ -300,12 +665,21 @@ def get_ion_mode(s):
         raise ValueError('ion mode must be "neg" or "pos"')
 
 if __name__=='__main__':
-    engine = get_engine()
-    initialize_schema(engine)
     try:
         ion_mode = get_ion_mode(sys.argv[1])
     except IndexError:
-        print 'Usage: python cli.py [ion mode: either "neg" or "pos"]'
+        print 'Usage: python cli.py [ion mode: either "neg" or "pos"] [storage: "partitioned" or "packed"]'
+        sys.exit(-1)
+    # a new database can be created with intensities partitioned by
+    # experiment or packed
+    storage = sys.argv[2] if len(sys.argv) > 2 else None
+    if storage not in [None, PARTITIONED, PACKED]:
+        print 'storage must be "partitioned" or "packed"'
+        sys.exit(-1)
+    engine = get_engine()
+    if storage and engine.dialect.name != 'postgresql':
+        print '%s storage needs PostgreSQL' % storage
         sys.exit(-1)
+    initialize_schema(engine, storage, log=console_log)
     shell = Shell(get_session_factory(),ion_mode)
     shell.cmdloop('DOMDB v1')
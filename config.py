@@ -8,6 +8,20 @@ WITH_MS2='with_ms2'
 EXCLUDE_CONTROLS='exclude_controls'
 INT_OVER_CONTROLS='int_over_controls'
 ATTRS='attrs'
+# statement timeouts in seconds for long commands, 0 for none
+SEARCH_TIMEOUT='search_timeout'
+MATCH_TIMEOUT='match_timeout'
+LOAD_TIMEOUT='load_timeout'
+REMOVE_TIMEOUT='remove_timeout'
+# directory of metabolite snapshots to search (see snapshot.py), or None
+SNAPSHOT_DIR='snapshot_dir'
+# megabytes of search and match results to keep in memory (see cache.py),
+# and a directory to keep them in as well, or None
+CACHE_SIZE='cache_size'
+CACHE_DIR='cache_dir'
+# file that timed searches and matches are logged to (see profiling.py),
+# or None
+QUERY_LOG='query_log'
 
 def get_default_config():
     return dict(
@@ -16,7 +30,15 @@ def get_default_config():
         with_ms2 = False,
         exclude_controls = True,
         int_over_controls = None,
-        attrs = []
+        attrs = [],
+        search_timeout = 0,
+        match_timeout = 0,
+        load_timeout = 0,
+        remove_timeout = 0,
+        snapshot_dir = None,
+        cache_size = 64,
+        cache_dir = None,
+        query_log = os.path.join(os.path.expanduser('~'),'.domdb_query_log.jsonl')
     )
 
 def str2bool(s):
@@ -34,16 +56,41 @@ def str2ioc(s):
         raise ValueError
     return ioc
 
+def str2size(s):
+    size = int(s)
+    if size < 0:
+        raise ValueError
+    return size
+
+def str2path(s):
+    if s in ['none','None','']:
+        return None
+    return s
+
 def attrs2list(s):
     return re.split(r', *',s)
 
+def str2timeout(s):
+    timeout = int(s)
+    if timeout < 0:
+        raise ValueError
+    return timeout
+
 CONFIG_CASTS = dict(
     ppm_diff=float,
     rt_diff=int,
     with_ms2=str2bool,
     exclude_controls=str2bool,
     int_over_controls=str2ioc,
-    attrs=attrs2list
+    attrs=attrs2list,
+    search_timeout=str2timeout,
+    match_timeout=str2timeout,
+    load_timeout=str2timeout,
+    remove_timeout=str2timeout,
+    snapshot_dir=str2path,
+    cache_size=str2size,
+    cache_dir=str2path,
+    query_log=str2path
 )
 
 def complete_config_key(config,text):
@@ -67,7 +114,10 @@ def load_config(dir=None):
         return json.load(inf)
 
 def initialize_config(dir=None):
+    # a saved config may predate some keys, which get their defaults
+    config = get_default_config()
     try:
-        return load_config(dir)
+        config.update(load_config(dir))
     except:
-        return get_default_config()
+        pass
+    return config
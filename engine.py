@@ -1,21 +1,51 @@
 import os
 
 import sqlalchemy
-from sqlalchemy import func
+from sqlalchemy import func, event
 from sqlalchemy.orm import sessionmaker
 
 from db import DATABASE_URL
 
-def get_sqlite_engine(delete=True):
+# milliseconds a SQLite connection waits for another's write lock, e.g.
+# a shell command while a background job loads an experiment, before
+# giving up with "database is locked"
+SQLITE_BUSY_TIMEOUT=600000
+
+def get_sqlite_engine(delete=True, path='kuj2.db'):
     # first, toast db
-    DB_FILE = 'kuj2.db'
+    DB_FILE = path
     if delete and os.path.exists(DB_FILE):
         try:
             os.remove(DB_FILE)
         except:
             print 'unable to delete %s' % DB_FILE
             raise
-    return sqlalchemy.create_engine('sqlite:///%s' % DB_FILE)
+    engine = sqlalchemy.create_engine('sqlite:///%s' % DB_FILE)
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, record):
+        # lets searches read while an experiment is being loaded
+        cursor = dbapi_connection.cursor()
+        cursor.execute('pragma journal_mode=wal')
+        cursor.execute('pragma synchronous=normal')
+        cursor.execute('pragma busy_timeout=%d' % SQLITE_BUSY_TIMEOUT)
+        cursor.close()
+    return engine
+
+# connection pool. interactive use needs few connections, but a
+# streaming export holds one for as long as it runs
+POOL_SIZE=5
+MAX_OVERFLOW=10
+POOL_RECYCLE=3600 # seconds before a pooled connection is replaced
 
 def get_psql_engine():
-    return sqlalchemy.create_engine(DATABASE_URL)
+    return sqlalchemy.create_engine(DATABASE_URL,
+                                    pool_size=POOL_SIZE,
+                                    max_overflow=MAX_OVERFLOW,
+                                    pool_recycle=POOL_RECYCLE)
+
+def get_db_engine():
+    """the engine for DATABASE_URL, which is either a PostgreSQL URL or
+    sqlite:///path for a local database file"""
+    if DATABASE_URL.startswith('sqlite:///'):
+        return get_sqlite_engine(delete=False, path=DATABASE_URL[len('sqlite:///'):])
+    return get_psql_engine()
@@ -0,0 +1,138 @@
+import sys
+import threading
+import Queue
+from itertools import islice, izip, imap
+from cStringIO import StringIO
+
+import numpy as np
+
+# bulk loading for etl. rows are written with COPY on PostgreSQL and
+# with executemany everywhere else, bypassing the ORM entirely
+
+CHUNK_SIZE=2000 # metabolites per round trip
+
+def is_postgres(conn):
+    return conn.dialect.name == 'postgresql'
+
+def copy_value(v):
+    """format a value for COPY text format"""
+    if v is None:
+        return '\\N'
+    if isinstance(v, (list, tuple)):
+        # array literal. elements are numbers, which need no quoting
+        return '{%s}' % ','.join(copy_value(e) for e in v)
+    if isinstance(v, float):
+        s = repr(v) # str() would truncate to 12 digits
+    else:
+        s = str(v)
+    return s.replace('\\','\\\\').replace('\t','\\t').replace('\n','\\n').replace('\r','\\r')
+
+def copy_from(conn, table, cols, buf):
+    """COPY the text format contents of buf into the given Table"""
+    buf.seek(0)
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (table.name, ','.join('"%s"' % c for c in cols)), buf)
+    finally:
+        cursor.close()
+
+def copy_rows(conn, table, cols, rows):
+    """bulk insert rows (sequences of values in the order of cols)
+    into the given Table. returns the number of rows written"""
+    rows = list(rows)
+    if not rows:
+        return 0
+    if is_postgres(conn):
+        buf = StringIO()
+        for row in rows:
+            buf.write('\t'.join(copy_value(v) for v in row))
+            buf.write('\n')
+        copy_from(conn, table, cols, buf)
+    else:
+        conn.execute(table.insert(), [dict(zip(cols,row)) for row in rows])
+    return len(rows)
+
+def copy_arrays(conn, table, cols, arrays):
+    """bulk insert parallel 1-d arrays, one per column in cols, into
+    the given Table. returns the number of rows written"""
+    columns = [a.tolist() for a in arrays]
+    if not columns or not columns[0]:
+        return 0
+    if not is_postgres(conn):
+        return copy_rows(conn, table, cols, izip(*columns))
+    # format each column in one pass instead of value by value
+    text = [imap(repr if a.dtype.kind == 'f' else str, c) for a, c in zip(arrays, columns)]
+    buf = StringIO()
+    for line in imap('\t'.join, izip(*text)):
+        buf.write(line)
+        buf.write('\n')
+    copy_from(conn, table, cols, buf)
+    return len(columns[0])
+
+def new_ids(conn, table, exp_id, after, n):
+    """ids of the n rows most recently bulk inserted into table for the
+    given experiment. ids are assigned in insertion order, so these are
+    the first n ids for that experiment greater than after"""
+    r = conn.execute('select id from %s where exp_id=%d and id > %d order by id limit %d' % (table.name, exp_id, after, n))
+    ids = [row[0] for row in r]
+    if len(ids) != n:
+        raise ValueError('expected %d new ids in %s, found %d' % (n, table.name, len(ids)))
+    return ids
+
+def read_chunks(reader, field_idx, value_idx, size=CHUNK_SIZE):
+    """parse the rows of a csv reader (positioned after the header) size
+    rows at a time. yields (fields, values) per chunk where fields is a
+    list of rows of the string columns at field_idx, and values is a
+    float array with one column per index in value_idx"""
+    while True:
+        rows = list(islice(reader, size))
+        if not rows:
+            return
+        rows = [row for row in rows if row] # skip blank lines
+        if not rows:
+            continue
+        try:
+            a = np.array(rows)
+            fields = a[:,field_idx].tolist()
+            values = a[:,value_idx].astype(np.float64)
+        except (IndexError, ValueError):
+            raise ValueError('malformed metabolite record near line %d' % reader.line_num)
+        yield fields, values
+
+def prefetch(iterable, depth=2):
+    """iterate over iterable while a producer thread computes up to depth
+    items ahead, so that producing the next item overlaps with consuming
+    the current one"""
+    q = Queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+    def produce():
+        try:
+            for item in iterable:
+                put((item, None))
+                if stop.is_set():
+                    return
+            put((done, None))
+        except:
+            put((done, sys.exc_info()))
+    t = threading.Thread(target=produce)
+    t.daemon = True
+    t.start()
+    try:
+        while True:
+            item, exc_info = q.get()
+            if item is done:
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                return
+            yield item
+    finally:
+        stop.set()
+        t.join()
@@ -0,0 +1,180 @@
+import time
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+# background jobs for long shell commands. each job runs in its own
+# thread with its own pooled connections. a job is cancelled by asking
+# the server to cancel whatever its connections are running and by
+# raising Cancelled at its next checkpoint
+
+PROGRESS_INTERVAL=5 # seconds between progress reports while waiting
+
+RUNNING='running'
+DONE='done'
+FAILED='failed'
+CANCELLED='cancelled'
+
+class Cancelled(Exception):
+    pass
+
+_local = threading.local()
+
+def current_job():
+    """the job running in this thread, if any"""
+    return getattr(_local, 'job', None)
+
+class Job(object):
+    def __init__(self, id, command, fn, timeout=None, background=False):
+        self.id = id
+        self.command = command
+        self.fn = fn
+        self.timeout = timeout
+        self.background = background
+        self.status = RUNNING
+        self.rows = 0
+        self.message = ''
+        self.started = time.time()
+        self.finished = None
+        self.reported = False
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._connections = set()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+    def _run(self):
+        _local.job = self
+        try:
+            with statement_timeout(self.timeout):
+                self.fn()
+            self.status = CANCELLED if self.cancelled() else DONE
+        except Exception as e:
+            if self.cancelled():
+                self.status = CANCELLED
+            else:
+                self.status = FAILED
+                self.message = 'ERROR: %s' % str(e).strip().split('\n')[0]
+        finally:
+            self.finished = time.time()
+            _local.job = None
+    def alive(self):
+        return self.thread.is_alive()
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+    def cancelled(self):
+        return self._cancel.is_set()
+    def cancel(self):
+        """cancel the job's running queries and stop it at its next
+        checkpoint"""
+        self._cancel.set()
+        with self._lock:
+            connections = list(self._connections)
+        for c in connections:
+            try:
+                c.cancel() # psycopg2 cancel request to the server
+            except Exception:
+                pass
+    def track(self, dbapi_connection):
+        with self._lock:
+            self._connections.add(dbapi_connection)
+    def untrack(self, dbapi_connection):
+        with self._lock:
+            self._connections.discard(dbapi_connection)
+    def describe(self):
+        if self.message:
+            return self.message
+        return '%d rows' % self.rows
+
+class Jobs(object):
+    def __init__(self):
+        self.jobs = []
+    def submit(self, command, fn, timeout=None, background=False):
+        job = Job(len(self.jobs) + 1, command, fn, timeout, background)
+        self.jobs.append(job)
+        job.thread.start()
+        return job
+    def get(self, id=None):
+        """the job with the given id, or the most recent one"""
+        if id is None:
+            return self.jobs[-1] if self.jobs else None
+        for job in self.jobs:
+            if job.id == id:
+                return job
+    def finished_unreported(self):
+        done = [job for job in self.jobs if not job.alive() and not job.reported]
+        for job in done:
+            job.reported = True
+        return done
+
+def wait(job, out=None):
+    """wait for a job in the foreground, reporting progress every
+    PROGRESS_INTERVAL seconds. Ctrl-C cancels the job"""
+    if out is None:
+        out = lambda x: None
+    last = time.time()
+    try:
+        while job.alive():
+            job.thread.join(0.2)
+            if job.alive() and time.time() - last >= PROGRESS_INTERVAL:
+                last = time.time()
+                out('[%d] %s, %ds elapsed' % (job.id, job.describe(), job.elapsed()))
+    except KeyboardInterrupt:
+        out('[%d] cancelling' % job.id)
+        job.cancel()
+        job.thread.join()
+    job.reported = True
+    return job
+
+def progress(rows=None, message=None):
+    """record progress of the current job, if any, and stop it there if
+    it has been cancelled"""
+    job = current_job()
+    if job is None:
+        return
+    if rows is not None:
+        job.rows = rows
+    if message is not None:
+        job.message = message
+    if job.cancelled():
+        raise Cancelled('cancelled')
+
+@contextmanager
+def statement_timeout(seconds):
+    """limit statements run on connections checked out in this thread
+    to the given number of seconds (None or 0 for no limit). needs
+    install"""
+    old = getattr(_local, 'timeout', None)
+    _local.timeout = seconds
+    try:
+        yield
+    finally:
+        _local.timeout = old
+
+def install(engine):
+    """track the connections each job checks out of engine's pool so
+    that they can be cancelled, and apply statement timeouts to them"""
+    if engine.dialect.name != 'postgresql':
+        return
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, record, proxy):
+        timeout = int((getattr(_local, 'timeout', None) or 0) * 1000)
+        if record.info.get('statement_timeout', 0) != timeout:
+            cursor = dbapi_connection.cursor()
+            cursor.execute('set statement_timeout = %d' % timeout)
+            cursor.close()
+            dbapi_connection.commit() # nothing else is pending at checkout
+            record.info['statement_timeout'] = timeout
+        job = current_job()
+        if job is not None:
+            job.track(dbapi_connection)
+            record.info['job'] = job
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # a cancel that arrives between statements stops the next one
+        progress()
+    @event.listens_for(engine, 'checkin')
+    def checkin(dbapi_connection, record):
+        job = record.info.pop('job', None)
+        if job is not None:
+            job.untrack(dbapi_connection)
@@ -5,19 +5,37 @@ import json
 from contextlib import contextmanager
 import traceback
 
-from sql_templates import CREATE_VIEWS
+import numpy as np
+from jinja2 import Environment
+
+import sql_templates
+import sqlite_templates
+from sql_templates import CREATE_INDEXES, POPULATE_MTAB_SAMPLE_ATTR, CREATE_INTENSITY_INDEXES, CREATE_PIVOT, PIVOT_EXP_INDEX
+from sql_templates import CREATE_PARTITIONED_INTENSITY, RENAME_UNPARTITIONED_INTENSITY, DROP_UNPARTITIONED_INTENSITY, INTENSITY_IS_PARTITIONED
+from sql_templates import CREATE_INTENSITY_PARTITION_TEMPLATE, ATTACH_INTENSITY_PARTITION_TEMPLATE, DROP_INTENSITY_PARTITION_TEMPLATE
+from sql_templates import COUNT_INTENSITY_PARTITION_TEMPLATE, COPY_UNPARTITIONED_INTENSITY_TEMPLATE
+from sql_templates import CREATE_PACKED_INTENSITY, PACKED_INTENSITY_VIEW, INDEX_INTENSITY_SAMPLES, PACK_INTENSITIES, DROP_INTENSITY_TABLE
+from sql_templates import DROP_MTAB_SAMPLE_ATTR_VIEW, FLOAT_COLUMNS, FLOAT_MTAB_SAMPLE_ATTR, FLOAT_INTENSITY
+from sql_templates import ADD_MAX_INT_CONTROLS
+from ingest import copy_rows, copy_arrays, new_ids, read_chunks, prefetch
+from utils import ppm_bounds, ppm_window, rt_window, format_value
+from band_join import band_join
 
 import sqlalchemy
 from sqlalchemy.sql.functions import coalesce
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey, Numeric
-from sqlalchemy import func, and_, distinct, select
-from sqlalchemy.schema import DDL
-from sqlalchemy.orm import sessionmaker, relationship, backref, aliased, column_property
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey, Float, REAL
+from sqlalchemy import func, and_, or_, distinct, select, table, column
+from sqlalchemy.schema import DDL, Index
+from sqlalchemy.orm import sessionmaker, relationship, backref, column_property, joinedload
 from sqlalchemy.types import PickleType
 
 Base = declarative_base()
 
+# double precision. arbitrary precision numeric made every comparison
+# and average slow, and is far more precise than the data
+DOUBLE = Float(precision=53)
+
 class Exp(Base):
     __tablename__ = 'experiment'
 
@@ -31,13 +49,13 @@ class Mtab(Base):
     __tablename__ = 'metabolite'
 
     id = Column(Integer, primary_key=True)
-    exp_id = Column(Integer, ForeignKey('experiment.id'))
-    mz = Column(Numeric, index=True) # mass-to-charge ratio
-    mzmin = Column(Numeric)
-    mzmax = Column(Numeric)
-    rt = Column(Numeric, index=True) # retention time (seconds)
-    rtmin = Column(Numeric)
-    rtmax = Column(Numeric)
+    exp_id = Column(Integer, ForeignKey('experiment.id'), index=True)
+    mz = Column(DOUBLE, index=True) # mass-to-charge ratio
+    mzmin = Column(DOUBLE)
+    mzmax = Column(DOUBLE)
+    rt = Column(DOUBLE, index=True) # retention time (seconds)
+    rtmin = Column(DOUBLE)
+    rtmax = Column(DOUBLE)
     isotopes = Column(String)
     adduct = Column(String)
     pcgroup = Column(Integer)
@@ -46,6 +64,9 @@ class Mtab(Base):
 
     exp = relationship(Exp, backref=backref('mtabs', cascade='all,delete-orphan'))
 
+    # for m/z and rt range searches
+    __table_args__ = (Index('ix_metabolite_mz_rt', 'mz', 'rt'),)
+
     def __repr__(self):
         if self.withMS2==1:
             ms2 = 'with MS2'
@@ -67,7 +88,7 @@ class SampleAttr(Base):
     __tablename__ = 'sample_attr'
 
     id = Column(Integer, primary_key=True)
-    sample_id = Column(Integer, ForeignKey('sample.id'))
+    sample_id = Column(Integer, ForeignKey('sample.id'), index=True)
     name = Column(String)
     value = Column(String)
 
@@ -77,18 +98,381 @@ class MtabIntensity(Base):
     __tablename__ = 'intensity'
 
     id = Column(Integer, primary_key=True)
-    sample_id = Column(Integer, ForeignKey('sample.id'))
-    mtab_id = Column(Integer, ForeignKey('metabolite.id'))
-    intensity = Column(Numeric)
+    sample_id = Column(Integer, ForeignKey('sample.id'), index=True)
+    mtab_id = Column(Integer, ForeignKey('metabolite.id'), index=True)
+    intensity = Column(REAL)
 
     sample = relationship(Sample, backref=backref('intensities', cascade='all,delete-orphan'))
     mtab = relationship(Mtab, backref=backref('intensities', cascade='all,delete-orphan'))
 
-def initialize_schema(engine):
+class MtabSummary(Base):
+    __tablename__ = 'mtab_summary'
+
+    # no foreign key, so that rows can outlive their metabolite until
+    # the experiment is refreshed (see refresh_exp)
+    mtab_id = Column(Integer, primary_key=True)
+    exp_id = Column(Integer, index=True)
+    avg_int_controls = Column(DOUBLE) # mean intensity over control samples
+    max_int_samples = Column(DOUBLE) # max intensity over non-control samples
+    max_int_controls = Column(DOUBLE) # max intensity over control samples
+    n_nonzero = Column(Integer) # non-control samples with nonzero intensity
+
+# per-metabolite intensity summary, zero when there is none
+Mtab.avg_int_controls = column_property(
+    select([coalesce(MtabSummary.avg_int_controls, 0)]).\
+    where(MtabSummary.mtab_id==Mtab.id).as_scalar())
+Mtab.max_int_samples = column_property(
+    select([coalesce(MtabSummary.max_int_samples, 0)]).\
+    where(MtabSummary.mtab_id==Mtab.id).as_scalar())
+Mtab.max_int_controls = column_property(
+    select([coalesce(MtabSummary.max_int_controls, 0)]).\
+    where(MtabSummary.mtab_id==Mtab.id).as_scalar())
+
+class ExpStats(Base):
+    __tablename__ = 'exp_stats'
+
+    exp_id = Column(Integer, primary_key=True)
+    samples = Column(Integer) # number of samples
+    metabolites = Column(Integer) # number of metabolites
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True) # migrations applied
+
+class DataGeneration(Base):
+    __tablename__ = 'data_generation'
+
+    # a row is added whenever experiments are added or removed, so that
+    # the latest identifies the data queries see (see data_generation)
+    generation = Column(Integer, primary_key=True)
+
+# packed intensity storage, created with DDL (see
+# sql_templates.CREATE_PACKED_INTENSITY) since it is PostgreSQL only
+intensity_sample = table('intensity_sample', column('exp_id'), column('idx'), column('sample_id'))
+intensity_packed = table('intensity_packed', column('mtab_id'), column('exp_id'), column('sample_idx'), column('intensities'))
+
+# R*Tree of metabolite m/z and rt on SQLite (see
+# sqlite_templates.CREATE_RTREE)
+metabolite_rtree = table('metabolite_rtree', column('id'))
+
+# ways of storing intensities other than one row per intensity in an
+# ordinary table
+PARTITIONED='partitioned'
+PACKED='packed'
+
+def initialize_schema(engine, storage=None, log=None):
+    """create whatever tables, indexes and views do not exist yet. a new
+    database gets an intensity table partitioned by experiment if
+    storage is PARTITIONED (PostgreSQL 11 or later), or packed
+    intensities if storage is PACKED. an existing database keeps the
+    intensities it has; see partition_intensities and pack_intensities.
+    an existing database is migrated to the current schema"""
+    c = engine.connect()
+    new = not engine.dialect.has_table(c, Exp.__tablename__)
+    summarize = not engine.dialect.has_table(c, MtabSummary.__tablename__)
+    count = not engine.dialect.has_table(c, ExpStats.__tablename__)
+    create = storage and not engine.dialect.has_table(c, MtabIntensity.__tablename__)
+    spatial_index = c.dialect.name == 'sqlite' and not engine.dialect.has_table(c, 'metabolite_rtree')
+    c.close()
+    if create:
+        # intensity references the other tables, so they come first
+        Base.metadata.create_all(engine, tables=[t for t in Base.metadata.sorted_tables
+                                                 if t is not MtabIntensity.__table__])
+        c = engine.connect()
+        if storage == PACKED:
+            for ci in CREATE_PACKED_INTENSITY + [PACKED_INTENSITY_VIEW]:
+                c.execute(DDL(ci))
+        else:
+            for ci in CREATE_PARTITIONED_INTENSITY:
+                c.execute(DDL(ci))
+        c.close()
     Base.metadata.create_all(engine)
     c = engine.connect()
-    for cv in CREATE_VIEWS:
-        c.execute(DDL(cv))
+    if spatial_index:
+        c.execute(DDL(sqlite_templates.CREATE_RTREE))
+        c.execute(sqlite_templates.POPULATE_RTREE)
+    if c.execute(templates(c).MTAB_SAMPLE_ATTR_IS_VIEW).scalar():
+        c.execute(DDL('drop view mtab_sample_attr'))
+    # indexes first, so that migrations that read intensities can use them
+    for ci in CREATE_INDEXES:
+        c.execute(DDL(ci))
+    if not is_packed(c):
+        for ci in CREATE_INTENSITY_INDEXES:
+            c.execute(DDL(ci))
+    if new: # created with the current schema
+        c.execute(SchemaVersion.__table__.insert(), version=len(MIGRATIONS))
+    else:
+        # summaries about to be built from scratch need no refresh
+        migrate(c, log, summarize=summarize)
+    populate = not engine.dialect.has_table(c, 'mtab_sample_attr')
+    create_views(c)
+    if populate:
+        c.execute(POPULATE_MTAB_SAMPLE_ATTR)
+    populate = not engine.dialect.has_table(c, 'sample_attr_pivot')
+    c.execute(DDL(CREATE_PIVOT))
+    c.execute(DDL(PIVOT_EXP_INDEX))
+    if populate:
+        for (exp_id,) in c.execute(select([Exp.id])).fetchall():
+            refresh_pivot(c, exp_id)
+    if summarize:
+        for (exp_id,) in c.execute(select([Exp.id])).fetchall():
+            refresh_summary(c, exp_id)
+    if count:
+        for (exp_id,) in c.execute(select([Exp.id])).fetchall():
+            refresh_stats(c, exp_id)
+    c.close()
+
+def migrate_float(conn, summarize=False):
+    """native floating point m/z, rt and intensity"""
+    if conn.dialect.name != 'postgresql': # other databases are always new
+        return
+    conn.execute(DDL(DROP_MTAB_SAMPLE_ATTR_VIEW))
+    for fc in FLOAT_COLUMNS:
+        conn.execute(DDL(fc))
+    if conn.dialect.has_table(conn, 'mtab_sample_attr'):
+        conn.execute(DDL(FLOAT_MTAB_SAMPLE_ATTR))
+    if not is_packed(conn):
+        conn.execute(DDL(FLOAT_INTENSITY))
+
+def migrate_max_int_controls(conn, summarize=False):
+    """max control intensity in the intensity summary"""
+    # a summary created by this initialize_schema has it already
+    columns = [col['name'] for col in sqlalchemy.inspect(conn).get_columns(MtabSummary.__tablename__)]
+    if 'max_int_controls' not in columns:
+        conn.execute(DDL(ADD_MAX_INT_CONTROLS))
+    if summarize: # initialize_schema summarizes every experiment next
+        return
+    for (exp_id,) in conn.execute(select([Exp.id])).fetchall():
+        refresh_summary(conn, exp_id)
+
+# schema migrations, in order. a database at version n has had the
+# first n applied. each is called with whether the intensity summary
+# is going to be rebuilt anyway
+MIGRATIONS=[
+    migrate_float,
+    migrate_max_int_controls
+]
+
+def schema_version(conn):
+    return conn.execute(select([func.max(SchemaVersion.version)])).scalar() or 0
+
+def migrate(conn, log=None, summarize=False):
+    """apply the migrations that the database has not had, each in its
+    own transaction. summarize is whether the caller rebuilds the
+    intensity summary of every experiment afterwards. returns the number
+    applied"""
+    if not log:
+        log = lambda x: None
+    version = schema_version(conn)
+    for n, migration in enumerate(MIGRATIONS[version:], version+1):
+        log('migrating schema to version %d: %s' % (n, migration.__doc__))
+        trans = conn.begin()
+        try:
+            migration(conn, summarize)
+            conn.execute(SchemaVersion.__table__.insert(), version=n)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+    return len(MIGRATIONS) - min(version, len(MIGRATIONS))
+
+def dialect_templates(dialect):
+    """the module of SQL templates for the named dialect"""
+    if dialect == 'sqlite':
+        return sqlite_templates
+    return sql_templates
+
+def templates(conn):
+    """the module of SQL templates for conn's database"""
+    return dialect_templates(conn.dialect.name)
+
+def create_views(conn):
+    t = templates(conn)
+    conn.execute(DDL(t.DROP_MTAB_SAMPLE_ATTR_VIEW))
+    conn.execute(DDL(Environment().from_string(t.MTAB_SAMPLE_ATTR_VIEW_TEMPLATE).render({
+        'by_exp': intensity_by_exp(conn)
+    })))
+    for cv in t.CREATE_VIEWS:
+        conn.execute(DDL(cv))
+
+def is_partitioned(conn):
+    """whether the intensity table is partitioned by experiment"""
+    if conn.dialect.name != 'postgresql':
+        return False
+    return conn.execute(INTENSITY_IS_PARTITIONED).scalar() > 0
+
+def is_packed(conn):
+    """whether intensities are packed, with intensity a view of them"""
+    return conn.dialect.has_table(conn, intensity_packed.name)
+
+def intensity_by_exp(conn):
+    """whether intensity has an exp_id column, so that joining it on
+    exp_id only reads an experiment's partition or packed rows"""
+    return is_partitioned(conn) or is_packed(conn)
+
+def render_partition(template, exp_id):
+    return Environment().from_string(template).render({
+        'exp_id': int(exp_id)
+    })
+
+def create_partition(conn, exp_id):
+    """create the intensity partition of an experiment, as a table that
+    is not attached yet. returns a Table for loading it"""
+    conn.execute(DDL(render_partition(CREATE_INTENSITY_PARTITION_TEMPLATE, exp_id)))
+    return table('intensity_%d' % int(exp_id))
+
+def attach_partition(conn, exp_id):
+    conn.execute(DDL(render_partition(ATTACH_INTENSITY_PARTITION_TEMPLATE, exp_id)))
+
+def drop_partition(conn, exp_id):
+    """drop the intensity partition of an experiment. returns the
+    number of intensities it had"""
+    n = conn.execute(render_partition(COUNT_INTENSITY_PARTITION_TEMPLATE, exp_id)).scalar()
+    conn.execute(DDL(render_partition(DROP_INTENSITY_PARTITION_TEMPLATE, exp_id)))
+    return n
+
+def partition_intensities(engine, log=None):
+    """convert an unpartitioned intensity table to one partitioned by
+    experiment, in one transaction. ids are kept. returns the number of
+    partitions created, or None if intensity is already partitioned"""
+    if not log:
+        log = lambda x: None
+    if engine.dialect.name != 'postgresql':
+        raise ValueError('partitioning needs PostgreSQL')
+    c = engine.connect()
+    try:
+        if is_partitioned(c):
+            return None
+        if is_packed(c):
+            raise ValueError('intensities are packed')
+        trans = c.begin()
+        try:
+            for ri in RENAME_UNPARTITIONED_INTENSITY:
+                c.execute(DDL(ri))
+            for ci in CREATE_PARTITIONED_INTENSITY:
+                c.execute(DDL(ci))
+            # indexes on the parent are built on each partition as it is attached
+            for ci in CREATE_INTENSITY_INDEXES:
+                c.execute(DDL(ci))
+            exp_ids = [row[0] for row in c.execute(select([Exp.id]).order_by(Exp.id))]
+            for n, exp_id in enumerate(exp_ids):
+                create_partition(c, exp_id)
+                c.execute(render_partition(COPY_UNPARTITIONED_INTENSITY_TEMPLATE, exp_id), exp_id)
+                attach_partition(c, exp_id)
+                log('partitioned %d of %d experiments' % (n+1, len(exp_ids)))
+            # the view still refers to the old table until it is replaced
+            create_views(c)
+            c.execute(DDL(DROP_UNPARTITIONED_INTENSITY))
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        return len(exp_ids)
+    finally:
+        c.close()
+
+def pack_intensities(engine, log=None):
+    """convert the intensity table, partitioned or not, to packed
+    intensities, in one transaction. returns the number of experiments
+    packed, or None if intensities are already packed"""
+    if not log:
+        log = lambda x: None
+    if engine.dialect.name != 'postgresql':
+        raise ValueError('packing needs PostgreSQL')
+    c = engine.connect()
+    try:
+        if is_packed(c):
+            return None
+        trans = c.begin()
+        try:
+            for ci in CREATE_PACKED_INTENSITY:
+                c.execute(DDL(ci))
+            c.execute(INDEX_INTENSITY_SAMPLES)
+            exp_ids = [row[0] for row in c.execute(select([Exp.id]).order_by(Exp.id))]
+            for n, exp_id in enumerate(exp_ids):
+                c.execute(PACK_INTENSITIES, exp_id)
+                log('packed %d of %d experiments' % (n+1, len(exp_ids)))
+            for di in DROP_INTENSITY_TABLE:
+                c.execute(DDL(di))
+            c.execute(DDL(PACKED_INTENSITY_VIEW))
+            create_views(c)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        return len(exp_ids)
+    finally:
+        c.close()
+
+def pack_rows(mtab_ids, exp_id, intensities):
+    """intensity_packed rows for metabolites with the given ids and rows
+    of intensities, one column per sample in the experiment's sample
+    order. sample indexes start at 1, like SQL arrays"""
+    for mtab_id, row in zip(mtab_ids, intensities):
+        nonzero = np.flatnonzero(row)
+        yield mtab_id, exp_id, (nonzero + 1).tolist(), row[nonzero].tolist()
+
+def pivot_columns(conn):
+    """names of the sample attributes that have a sample_attr_pivot column"""
+    return [row[0] for row in conn.execute(templates(conn).PIVOT_COLUMNS)]
+
+def refresh_pivot(conn, exp_id):
+    """rebuild the sample_attr_pivot rows of an experiment, adding
+    columns for attribute names not seen before"""
+    t = templates(conn)
+    names = sorted(row[0] for row in conn.execute(t.EXP_ATTR_NAMES, exp_id))
+    have = set(pivot_columns(conn))
+    quote = conn.dialect.identifier_preparer.quote_identifier
+    for name in names:
+        if name not in have:
+            # another etl may be adding the same column concurrently
+            conn.execute(DDL(Environment().from_string(t.ADD_PIVOT_COLUMN_TEMPLATE).render({
+                'col': quote(name)
+            })))
+    conn.execute(t.DELETE_PIVOT, exp_id)
+    query = Environment().from_string(t.REFRESH_PIVOT_TEMPLATE).render({
+        'cols': [quote(name) for name in names]
+    })
+    conn.execute(query, *(names + [exp_id]))
+
+def refresh_summary(conn, exp_id):
+    t = templates(conn)
+    query = Environment().from_string(t.REFRESH_MTAB_SUMMARY_TEMPLATE).render({
+        'by_exp': intensity_by_exp(conn)
+    })
+    conn.execute(t.DELETE_MTAB_SUMMARY, exp_id)
+    conn.execute(query, exp_id)
+
+def refresh_stats(conn, exp_id):
+    t = templates(conn)
+    conn.execute(t.DELETE_EXP_STATS, exp_id)
+    conn.execute(t.REFRESH_EXP_STATS, exp_id)
+
+def data_generation(conn):
+    """identifies the data in the database: it changes whenever an
+    experiment is added or removed, and not otherwise. results of
+    queries can be kept as long as it stays the same"""
+    return conn.execute(select([func.max(DataGeneration.generation)])).scalar() or 0
+
+def bump_generation(conn):
+    """record a change to the data. inserts rather than updates, so
+    that concurrent loads do not wait for each other"""
+    conn.execute(DataGeneration.__table__.insert())
+
+def refresh_exp(conn, exp_id):
+    """bring the materialized mtab_sample_attr rows, the intensity
+    summary, the counts, the attribute pivot and, on SQLite, the R*Tree
+    of an experiment up to date after it has been added or removed"""
+    t = templates(conn)
+    conn.execute(t.DELETE_MTAB_SAMPLE_ATTR, exp_id)
+    conn.execute(t.REFRESH_MTAB_SAMPLE_ATTR, exp_id)
+    refresh_summary(conn, exp_id)
+    refresh_stats(conn, exp_id)
+    if conn.dialect.name == 'sqlite':
+        conn.execute(sqlite_templates.INDEX_METABOLITES, exp_id)
+    # last, since adding a pivot column locks the table until commit
+    refresh_pivot(conn, exp_id)
 
 COMMON_FIELDS=set([
     'mz',
@@ -114,11 +498,16 @@ def etl(session, exp_name, df_path, mdf_path, ion_mode, log=None):
     if exp is None:
         exp = Exp(name=exp_name,ion_mode=ion_mode)
         session.add(exp)
+        session.flush() # assigns exp.id
     else:
         log("experiment %s has already been added to database, use 'remove %s' to remove it" % (exp_name, exp_name))
         return
+    # everything below is written in bulk on the session's connection,
+    # in the same transaction as the experiment
+    conn = session.connection()
     # first, do sample metadata for this experiment
-    samples = {}
+    sample_rows = []
+    sample_attrs = []
     ignored = 0
     required_sample_attrs = [FILE_NAME, CONTROL]
     with open(mdf_path,'rU') as cf:
@@ -129,52 +518,83 @@ def etl(session, exp_name, df_path, mdf_path, ion_mode, log=None):
                 continue # skip this sample
             name = d[FILE_NAME]
             control = int(d[CONTROL]) # 1 is True, 0 is False
-            sample = Sample(name=name,control=control)
-            samples[name] = sample
-            sample.exp = exp
-            session.add(sample)
-            # now add addrs
+            sample_rows.append((name, control, exp.id))
             for k,v in d.items():
                 if k not in required_sample_attrs:
-                    attr = SampleAttr(sample=sample, name=k, value=v)
-                    session.add(attr) # FIXME use association proxy
+                    sample_attrs.append((name, k, v))
+    copy_rows(conn, Sample.__table__, ['name','control','exp_id'], sample_rows)
+    # resolve sample ids by name in one query
+    samples = dict(conn.execute(select([Sample.name, Sample.id]).where(Sample.exp_id==exp.id)).fetchall())
+    copy_rows(conn, SampleAttr.__table__, ['sample_id','name','value'],
+              ((samples[name],k,v) for name,k,v in sample_attrs))
     log('%d total samples loaded, %d ignored' % (len(samples), ignored))
     n = 0
+    last_id = 0
+    mtab_fields = sorted(COMMON_FIELDS)
+    mtab_cols = mtab_fields + ['exp_id']
     # now add metabolite data
     with open(df_path,'rU') as cf:
         log('loading %s metabolite data from %s' % (exp_name, df_path))
-        for d in csv.DictReader(cf):
-            # subset the fields
-            keys = set(d.keys())
-            rest_keys = keys.difference(COMMON_FIELDS)
-            md = dict((k,d[k]) for k in COMMON_FIELDS)
-            md['exp'] = exp
-            # construct ORM object for metabolite
-            m = Mtab(**md)
+        reader = csv.reader(cf)
+        header = next(reader, [])
+        keys = set(header)
+        # resolve the header to fields and samples once
+        try:
+            field_idx = [header.index(k) for k in mtab_fields]
+        except ValueError:
+            log('ERROR: metabolite record is missing required columns %s' % sorted(COMMON_FIELDS.difference(keys)))
+            session.rollback()
+            return
+        sample_idx = [i for i,k in enumerate(header) if k not in COMMON_FIELDS and k in samples]
+        if not sample_idx:
+            log('ERROR: all samples missing from metabolite record, wrong metadata file?')
+            log('metabolite record columns (in no particular order): %s' % keys)
+            session.rollback()
+            return
+        sample_ids = np.array([samples[header[i]] for i in sample_idx])
+        # packed intensities are aligned with the experiment's sample
+        # order, which is recorded first. a partitioned experiment's
+        # intensities are loaded into a table of its own, which is
+        # attached when it is complete
+        packed = is_packed(conn)
+        partitioned = not packed and is_partitioned(conn)
+        if packed:
+            copy_rows(conn, intensity_sample, ['exp_id','idx','sample_id'],
+                      ((exp.id, k+1, sample_id) for k, sample_id in enumerate(sample_ids.tolist())))
+        elif partitioned:
+            intensity_table = create_partition(conn, exp.id)
+            intensity_cols = ['mtab_id','sample_id','intensity','exp_id']
+        else:
+            intensity_table = MtabIntensity.__table__
+            intensity_cols = ['mtab_id','sample_id','intensity']
+        # parse the next chunk while this one is being written
+        for fields, intensities in prefetch(read_chunks(reader, field_idx, sample_idx)):
+            copy_rows(conn, Mtab.__table__, mtab_cols, (f + [exp.id] for f in fields))
+            # resolve the new metabolite ids as a set
+            ids = new_ids(conn, Mtab.__table__, exp.id, last_id, len(fields))
+            last_id = ids[-1]
             # now record mtab intensity per sample
-            rest = dict((k,d[k]) for k in rest_keys if k)
-            n_samples = 0
-            for cn,s in rest.items():
-                if cn in samples:
-                    n_samples += 1
-                    sample = samples[cn]
-                    intensity = float(s)
-                    mi = MtabIntensity(mtab=m, sample=sample, intensity=intensity)
-                    # FIXME use association proxy
-                    session.add(mi)
-            if n_samples == 0:
-                log('ERROR: all samples missing from metabolite record, wrong metadata file?')
-                log('metabolite record columns (in no particular order): %s' % keys)
-                session.rollback()
-                return
-            # add to session
-            session.add(m)
-            n += 1
-            if n % 1000 == 0:
-                log('loaded %d metabolites so far' % n)
-                session.commit()
+            if packed:
+                copy_rows(conn, intensity_packed, ['mtab_id','exp_id','sample_idx','intensities'],
+                          pack_rows(ids, exp.id, intensities))
+            else:
+                columns = [
+                    np.repeat(ids, len(sample_ids)),
+                    np.tile(sample_ids, len(ids)),
+                    intensities.ravel()
+                ]
+                if partitioned:
+                    columns.append(np.repeat(exp.id, len(columns[0])))
+                copy_arrays(conn, intensity_table, intensity_cols, columns)
+            n += len(fields)
+            log('loaded %d metabolites so far' % n)
+    if partitioned:
+        attach_partition(conn, exp.id)
+    refresh_exp(conn, exp.id)
+    bump_generation(conn)
     session.commit()
     log('loaded %d total metabolites' % n)
+    return n
 
 # util
 def avoid_name_collisions(name,schema):
@@ -199,7 +619,7 @@ def default_config():
         WITH_MS2: False,
         EXCLUDE_CONTROLS: True,
         INT_OVER_CONTROLS: 0,
-        EXCLUDE_ATTRS: set()
+        EXCLUDE_ATTRS: {} # sample attribute name: value
     }
 
 def withms2_min(config):
@@ -214,10 +634,41 @@ class Db(object):
         self.ion_mode = ion_mode
         self.config = config
     def remove_exp(self,exp):
-        # http://stackoverflow.com/questions/19243964/python-sql-alchemy-cascade-delete
-        theExp = self.session.query(Exp).filter(Exp.ion_mode==self.ion_mode).filter(Exp.name==exp).first()
-        self.session.delete(theExp)
+        """delete an experiment and all its data with one DELETE per table,
+        in one transaction. returns a list of (table name, rows deleted),
+        or None if there is no such experiment. if intensity is
+        partitioned, the experiment's partition is dropped instead, and
+        if intensities are packed, its packed rows are deleted"""
+        exp_id = self.session.query(Exp.id).filter(Exp.ion_mode==self.ion_mode).filter(Exp.name==exp).scalar()
+        if exp_id is None:
+            return None
+        conn = self.session.connection()
+        mtab_ids = select([Mtab.id]).where(Mtab.exp_id==exp_id)
+        sample_ids = select([Sample.id]).where(Sample.exp_id==exp_id)
+        deletes = [ # children first, for the foreign keys
+            (SampleAttr.__table__, SampleAttr.sample_id.in_(sample_ids)),
+            (Mtab.__table__, Mtab.exp_id==exp_id),
+            (Sample.__table__, Sample.exp_id==exp_id),
+            (Exp.__table__, Exp.id==exp_id)
+        ]
+        counts = []
+        if is_packed(conn):
+            deletes[0:0] = [
+                (intensity_packed, intensity_packed.c.exp_id==exp_id),
+                (intensity_sample, intensity_sample.c.exp_id==exp_id)
+            ]
+        elif is_partitioned(conn):
+            counts.append((MtabIntensity.__tablename__, drop_partition(conn, exp_id)))
+        else:
+            deletes.insert(0, (MtabIntensity.__table__, MtabIntensity.mtab_id.in_(mtab_ids)))
+        if conn.dialect.name == 'sqlite':
+            deletes.insert(0, (metabolite_rtree, metabolite_rtree.c.id.in_(mtab_ids)))
+        for table, criterion in deletes:
+            counts.append((table.name, conn.execute(table.delete().where(criterion)).rowcount))
+        refresh_exp(conn, exp_id)
+        bump_generation(conn)
         self.session.commit()
+        return counts
     def all_attrs(self,exp=None):
         aa = {}
         for row in self.session.query(SampleAttr.name, SampleAttr.value).\
@@ -235,46 +686,124 @@ class Db(object):
         if exp is not None:
             q = q.filter(Mtab.exp.has(name=exp))
         return q.first()[0]
-    def match_all_from(self,exp):
-        m_alias = aliased(Mtab)
-        for row in self.session.query(Mtab, m_alias).\
-            filter(Mtab.exp.has(name=exp)).\
+    def _features(self,*criteria):
+        """ids, experiment ids, m/z and rt of the metabolites matching
+        criteria, as arrays"""
+        q = self.session.query(Mtab.id, Mtab.exp_id, Mtab.mz, Mtab.rt).\
             filter(Mtab.withMS2 >= withms2_min(self.config)).\
-            join((m_alias, and_(Mtab.id != m_alias.id, Mtab.exp_id != m_alias.exp_id))).\
-            filter(m_alias.withMS2 >= withms2_min(self.config)).\
-            filter(func.abs(Mtab.rt - m_alias.rt) <= self.config[RT_DIFF]).\
-            filter(func.abs(1e6 * (Mtab.mz - m_alias.mz) / m_alias.mz) <= self.config[PPM_DIFF]).\
-            join((Exp, Exp.id==m_alias.exp_id)).\
-            order_by(Mtab.mz, Exp.name).\
-            all():
-            yield row
+            filter(*criteria)
+        cols = zip(*q.all()) or [(),(),(),()]
+        ids, exp_ids, mz, rt = cols
+        return np.array(ids, dtype=np.int64), np.array(exp_ids, dtype=np.int64), \
+            np.array(mz, dtype=np.float64), np.array(rt, dtype=np.float64)
+    def _match_pairs(self,a,b,same_exp=True):
+        """ids of all pairs of distinct metabolites from features a and b
+        within the configured ppm/rt window, with the ppm difference
+        relative to the b metabolite"""
+        for i, j in band_join(a[2], a[3], b[2], b[3], self.config[PPM_DIFF], self.config[RT_DIFF], relative_to='b'):
+            keep = a[0][i] != b[0][j]
+            if not same_exp:
+                keep &= a[1][i] != b[1][j]
+            for pair in zip(a[0][i][keep].tolist(), b[0][j][keep].tolist()):
+                yield pair
+    def _mtabs(self,ids,batch_size=1000):
+        """load metabolites by id, with their experiments"""
+        ids = sorted(set(ids))
+        mtabs = {}
+        for k in range(0, len(ids), batch_size):
+            for m in self.session.query(Mtab).options(joinedload(Mtab.exp)).\
+                filter(Mtab.id.in_(ids[k:k+batch_size])):
+                mtabs[m.id] = m
+        return mtabs
+    def match_all_from(self,exp):
+        a = self._features(Mtab.exp.has(name=exp))
+        b = self._features()
+        pairs = list(self._match_pairs(a, b, same_exp=False))
+        mtabs = self._mtabs([id for pair in pairs for id in pair])
+        pairs.sort(key=lambda (a_id, b_id): (mtabs[a_id].mz, mtabs[b_id].exp.name))
+        for a_id, b_id in pairs:
+            yield mtabs[a_id], mtabs[b_id]
     def match_all(self):
-        m_alias = aliased(Mtab)
-        for row in self.session.query(Mtab, m_alias).\
-            filter(Mtab.withMS2 >= withms2_min(self.config)).\
-            join((m_alias, Mtab.id != m_alias.id)).\
-            filter(m_alias.withMS2 >= withms2_min(self.config)).\
-            filter(func.abs(Mtab.rt - m_alias.rt) <= self.config[RT_DIFF]).\
-            filter(func.abs(1e6 * (Mtab.mz - m_alias.mz) / m_alias.mz) <= self.config[PPM_DIFF]).\
-            all():
-            yield row
+        a = self._features()
+        pairs = list(self._match_pairs(a, a))
+        mtabs = self._mtabs([id for pair in pairs for id in pair])
+        for a_id, b_id in pairs:
+            yield mtabs[a_id], mtabs[b_id]
     def match_one(self,m):
+        mz_lo, mz_hi = ppm_window(m.mz, self.config[PPM_DIFF])
+        rt_lo, rt_hi = rt_window(m.rt, self.config[RT_DIFF])
         for row in self.session.query(Mtab).\
             filter(Mtab.id != m.id).\
             filter(Mtab.withMS2 >= withms2_min(self.config)).\
+            filter(Mtab.mz.between(mz_lo, mz_hi)).\
+            filter(Mtab.rt.between(rt_lo, rt_hi)).\
             filter(func.abs(Mtab.rt - m.rt) <= self.config[RT_DIFF]).\
             filter(func.abs(1e6 * (Mtab.mz - m.mz) / m.mz) <= self.config[PPM_DIFF]).\
             all():
             yield row
     def mtab_search(self,mz,rt):
+        mz_lo, mz_hi = ppm_bounds(mz, self.config[PPM_DIFF])
+        rt_lo, rt_hi = rt_window(rt, self.config[RT_DIFF])
         for m in self.session.query(Mtab).\
             filter(Mtab.withMS2 >= withms2_min(self.config)).\
+            filter(Mtab.mz.between(mz_lo, mz_hi)).\
+            filter(Mtab.rt.between(rt_lo, rt_hi)).\
             filter(func.abs(1e6 * (mz - Mtab.mz) / Mtab.mz) <= self.config[PPM_DIFF]).\
             filter(func.abs(rt - Mtab.rt) <= self.config[RT_DIFF]):
             yield m
     def mtab_random(self):
-        return self.session.query(Mtab).order_by(func.random()).limit(1)[0]
+        """a metabolite picked uniformly at random. skips to a random
+        offset in id order, which walks the primary key index instead of
+        sorting the whole table by random()"""
+        n = self.session.query(func.count(Mtab.id)).scalar()
+        return self.session.query(Mtab).order_by(Mtab.id).offset(np.random.randint(n)).limit(1)[0]
+    def _excluded_by_attrs(self,ids,batch_size=1000):
+        """ids of the metabolites with an intensity in a sample that has
+        any of the configured EXCLUDE_ATTRS (name: value)"""
+        exclude_attrs = self.config.get(EXCLUDE_ATTRS) or {}
+        if not exclude_attrs:
+            return set()
+        criterion = or_(*[and_(SampleAttr.name==k, SampleAttr.value==v) for k, v in exclude_attrs.items()])
+        excluded = set()
+        for k in range(0, len(ids), batch_size):
+            q = self.session.query(MtabIntensity.mtab_id).\
+                join(SampleAttr, SampleAttr.sample_id==MtabIntensity.sample_id).\
+                filter(MtabIntensity.mtab_id.in_(ids[k:k+batch_size])).\
+                filter(criterion).\
+                distinct()
+            excluded.update(row[0] for row in q)
+        return excluded
+    def _intensities(self,ids,batch_size=1000):
+        """nonzero intensities of metabolites by id, as lists of (sample
+        id, intensity) in the order they were loaded"""
+        intensities = {}
+        for k in range(0, len(ids), batch_size):
+            for mtab_id, sample_id, intensity in self.session.query(MtabIntensity.mtab_id,
+                                                                     MtabIntensity.sample_id,
+                                                                     MtabIntensity.intensity).\
+                filter(MtabIntensity.mtab_id.in_(ids[k:k+batch_size])).\
+                filter(MtabIntensity.intensity > 0).\
+                order_by(MtabIntensity.mtab_id, MtabIntensity.id):
+                intensities.setdefault(mtab_id, []).append((sample_id, intensity))
+        return intensities
+    def _samples(self,ids,batch_size=1000):
+        """name, control and list of (name, value) attrs of samples by id"""
+        samples = {}
+        for k in range(0, len(ids), batch_size):
+            for sample_id, name, control in self.session.query(Sample.id, Sample.name, Sample.control).\
+                filter(Sample.id.in_(ids[k:k+batch_size])):
+                samples[sample_id] = (name, control, [])
+            for sample_id, name, value in self.session.query(SampleAttr.sample_id, SampleAttr.name, SampleAttr.value).\
+                filter(SampleAttr.sample_id.in_(ids[k:k+batch_size])).\
+                order_by(SampleAttr.sample_id, SampleAttr.id):
+                samples[sample_id][2].append((name, value))
+        return samples
     def matches_as_csv(self,pairs):
+        """format (metabolite, match) pairs as CSV lines, one per nonzero
+        intensity of each match that passes the configured exclusions.
+        the matches' intensities, samples and sample attributes are
+        fetched for all of them at once. returns the lines and the
+        number of matches included"""
         exclude_controls = self.config[EXCLUDE_CONTROLS]
         int_over_controls = self.config[INT_OVER_CONTROLS]
         out_recs = []
@@ -292,31 +821,31 @@ class Db(object):
             'intensity', # intensity of matched mtab in that sample
             'control' # is that sample a control sample
         ]
-        n = 0
+        pairs = list(pairs)
+        # the matches to include. the intensity summary is loaded with
+        # each metabolite, so only the attribute exclusion is a query
+        keep = set()
         for m, match in pairs:
             # exclude controls
-            is_control = [mi.intensity>0 and mi.sample.control==1 for mi in match.intensities]
-            if exclude_controls and any(is_control):
+            if exclude_controls and match.avg_int_controls > 0:
                 continue
-            # exclude matches not intense enough over controls
-            aic = float(match.avg_int_controls) * int_over_controls
-            is_le_aic = [float(mi.intensity) <= aic for mi in match.intensities]
-            if all(is_le_aic):
+            # exclude matches not intense enough over controls in any
+            # sample, controls included
+            if max(match.max_int_samples, match.max_int_controls) <= match.avg_int_controls * (int_over_controls or 0):
                 continue
-            # now exclude based on sample attrs
-            exclude = False
-            for mi in match.intensities:
-                for k,v in self.config[EXCLUDE_ATTRS].items():
-                    for attr in mi.sample.attrs:
-                        if attr.name==k and attr.value==v:
-                            exclude = True
-            if exclude:
+            keep.add(match.id)
+        # now exclude based on sample attrs
+        keep -= self._excluded_by_attrs(sorted(keep))
+        intensities = self._intensities(sorted(keep))
+        samples = self._samples(sorted(set(sample_id for rows in intensities.values() for sample_id, _ in rows)))
+        n = 0
+        for m, match in pairs:
+            if match.id not in keep:
                 continue
             # this mtab will be included in results, count as a match
             n += 1
-            for mi in match.intensities:
-                if mi.intensity <= 0: # FIXME unnecessary if excluded from db
-                    continue
+            for sample_id, intensity in intensities.get(match.id, []):
+                name, control, attrs = samples[sample_id]
                 # populate fixed schema
                 out_rec = {
                     'mtab_exp': m.exp.name,
@@ -327,15 +856,15 @@ class Db(object):
                     'match_mz': match.mz,
                     'match_rt': match.rt,
                     'match_annotated': match.annotated,
-                    'sample': mi.sample.name,
-                    'intensity': mi.intensity,
-                    'control': mi.sample.control
+                    'sample': name,
+                    'intensity': intensity,
+                    'control': control
                 }
                 # now populate variable (per experiment) schema
-                for attr in mi.sample.attrs:
+                for attr_name, attr_value in attrs:
                     # avoid collisions of attr names
-                    attrname = avoid_name_collisions(attr.name, out_rec)
-                    out_rec[attrname] = attr.value
+                    attrname = avoid_name_collisions(attr_name, out_rec)
+                    out_rec[attrname] = attr_value
                     if attrname not in out_schema: # keep track of all attributes we find
                         out_schema.append(attrname)
                 out_recs.append(out_rec) # save record
@@ -345,7 +874,7 @@ class Db(object):
             yield ','.join(out_schema)
             for rec in out_recs:
                 out_row = [rec.get(k,'') for k in out_schema]
-                yield ','.join(map(str,out_row)) # FIXME format numbers better
+                yield ','.join(map(format_value,out_row))
         return list(outlines()), n
     def ctest(self):
         mtab = self.mtab_random()
@@ -355,17 +884,49 @@ class Db(object):
             filter(Mtab.id==mtab.id).\
             group_by(Mtab, Sample.control):
             print row
+    def match_density(self,n=None,seed=None):
+        """the distribution of the number of metabolites within the
+        configured ppm/rt window of each metabolite, counting itself, by
+        ion mode and experiment. the ppm difference is relative to the
+        metabolite, as in match_one, and the metabolites in its window
+        are those of the same ion mode with the configured MS2. all
+        windows are counted in one band join over the whole catalog. if n
+        is given, only n metabolites picked uniformly at random are
+        counted, which estimates the distribution. returns a dict of (ion
+        mode, experiment name) to a dict of number of matches to number
+        of metabolites"""
+        q = self.session.query(Exp.ion_mode, Mtab.id, Mtab.exp_id, Mtab.mz, Mtab.rt, Mtab.withMS2).\
+            join(Exp, Exp.id==Mtab.exp_id)
+        cols = zip(*q.all()) or [(),(),(),(),(),()]
+        modes = np.array(cols[0], dtype=object)
+        ids = np.array(cols[1], dtype=np.int64)
+        exp_ids = np.array(cols[2], dtype=np.int64)
+        mz = np.array(cols[3], dtype=np.float64)
+        rt = np.array(cols[4], dtype=np.float64)
+        in_window = np.array(cols[5], dtype=np.int64) >= withms2_min(self.config)
+        picked = np.arange(len(ids))
+        if n is not None and n < len(ids):
+            picked = np.sort(np.random.RandomState(seed).choice(len(ids), n, replace=False))
+        exp_names = dict(self.session.query(Exp.id, Exp.name))
+        density = {}
+        for mode in sorted(set(modes.tolist())):
+            a = picked[modes[picked] == mode]
+            b = np.flatnonzero((modes == mode) & in_window)
+            counts = np.zeros(len(a), dtype=np.int64)
+            for i, j in band_join(mz[a], rt[a], mz[b], rt[b], self.config[PPM_DIFF], self.config[RT_DIFF], relative_to='a'):
+                keep = ids[a][i] != ids[b][j]
+                counts += np.bincount(i[keep], minlength=len(a))
+            for exp_id in np.unique(exp_ids[a]).tolist():
+                pdf = np.bincount(counts[exp_ids[a] == exp_id] + 1)
+                density[(mode, exp_names[exp_id])] = dict((n_ms, c) for n_ms, c in enumerate(pdf.tolist()) if c)
+        return density
     def mtab_dist(self,n=1000):
+        """number of metabolites by number of matches, counting itself,
+        estimated from n metabolites picked at random (see match_density)"""
         pdf = {}
-        for i in range(n):
-            mtab = self.mtab_random()
-            n_ms = len(list(self.match_one(mtab))) + 1
-            if n_ms > 1:
-                print mtab, n_ms
-            if n_ms not in pdf:
-                pdf[n_ms] = 1
-            else:
-                pdf[n_ms] = pdf[n_ms] + 1
+        for d in self.match_density(n).values():
+            for n_ms, c in d.items():
+                pdf[n_ms] = pdf.get(n_ms, 0) + c
         return pdf
 
 @contextmanager
@@ -1,70 +1,429 @@
-from engine import get_psql_engine
+import csv
+
 from jinja2 import Environment
 
-from sql_templates import SIMPLE_SEARCH_TEMPLATE, SEARCH_TEMPLATE, SIMPLE_MATCH_TEMPLATE, MATCH_TEMPLATE
+from sqlite_templates import ATTR_SEPARATOR
 
+from kuj_orm import pivot_columns, intensity_by_exp, templates, dialect_templates, data_generation
 from config import PPM_DIFF,RT_DIFF,WITH_MS2,EXCLUDE_CONTROLS,INT_OVER_CONTROLS,ATTRS
+from utils import ppm_bounds, ppm_window, rt_window, format_value, EPSILON
+from profiling import Profile
+
+FETCH_SIZE=5000 # rows per round trip when streaming results
+TARGET_PARAMS=7 # SQLite params per target (see construct_target_search)
+
+# rendered queries by template and template params. the params only
+# describe the shape of the config (which attrs, whether there is an
+# ioc, etc.), not its values, so there are few of them
+_rendered = {}
+
+def render(template,context):
+    key = (template,) + tuple(sorted((k, tuple(v) if isinstance(v,list) else v)
+                                     for k, v in context.items()))
+    if key not in _rendered:
+        _rendered[key] = Environment().from_string(template).render(context)
+    return _rendered[key]
+
+def prepare(c,query):
+    """name and number of params of a server-side prepared statement
+    for query on connection c. the statement is prepared the first time
+    query is run on the underlying database connection, which outlives
+    c in the engine's pool"""
+    statements = c.info.setdefault('prepared', {})
+    if query not in statements:
+        name = 'domdb_q%d' % len(statements)
+        n = query.count('%s')
+        numbered = query % tuple('$%d' % (i+1) for i in range(n))
+        # on the DBAPI cursor, so the result does not close c
+        cursor = c.connection.cursor()
+        try:
+            cursor.execute('prepare %s as %s' % (name, numbered))
+        finally:
+            cursor.close()
+        statements[query] = (name, n)
+    return statements[query]
+
+def execute_prepared(c,query,params):
+    """run query as a prepared statement, which skips parsing and
+    planning it again after the first time. returns ResultProxy"""
+    if c.dialect.name != 'postgresql':
+        return c.execute(query,[params])
+    name, n = prepare(c,query)
+    return c.execute('execute %s(%s)' % (name, ', '.join(['%s'] * n)),[params])
+
+def construct_search(mz,rt,ion_mode,config,pivot_attrs=None,by_exp=False,dialect='postgresql',ids=None):
+    """pivot_attrs are the names of the sample attributes that have a
+    pivot column (see kuj_orm.pivot_columns). if not given, all attrs
+    in the config are assumed to. by_exp is whether intensity has an
+    exp_id column (see kuj_orm.intensity_by_exp). dialect is the name
+    of the database's dialect, which determines the templates. ids are
+    the ids of the metabolites in the window, if they are already known
+    (see snapshot.Snapshot.search), in which case the database does not
+    look for them"""
+    t = dialect_templates(dialect)
+    ppm_diff = config.get(PPM_DIFF)
+    rt_diff = config.get(RT_DIFF)
+    ioc = config.get(INT_OVER_CONTROLS)
+    attrs = config.get(ATTRS)
+    with_ms2 = config.get(WITH_MS2)
+    exclude_controls = config.get(EXCLUDE_CONTROLS)
+    context = {
+        'with_ms2': with_ms2
+    }
+    if ids is not None:
+        if dialect == 'sqlite':
+            context['ids'] = len(ids)
+            window = tuple(ids)
+        else:
+            context['ids'] = True
+            window = (list(ids),)
+    else:
+        window = (ion_mode,) + ppm_bounds(mz,ppm_diff) + rt_window(rt,rt_diff) + (mz,ppm_diff,rt,rt_diff)
+    if not exclude_controls:
+        query = render(t.SIMPLE_SEARCH_TEMPLATE,context)
+        params = window
+    else:
+        context.update({
+            'attrs': attrs,
+            'pivot_attrs': [a for a in attrs if pivot_attrs is None or a in pivot_attrs],
+            'by_exp': by_exp,
+            'ioc': ioc is not None
+        })
+        query = render(t.SEARCH_TEMPLATE,context)
+        if ioc is not None:
+            params = window + (ioc,)
+        else:
+            params = window
+    return query, params
 
-def construct_search(mz,rt,ion_mode,config):
+def construct_target_search(targets,ion_mode,config,pivot_attrs=None,by_exp=False,dialect='postgresql'):
+    """targets is a list of (target id, mz, rt). see construct_search"""
+    t = dialect_templates(dialect)
     ppm_diff = config.get(PPM_DIFF)
     rt_diff = config.get(RT_DIFF)
     ioc = config.get(INT_OVER_CONTROLS)
     attrs = config.get(ATTRS)
     with_ms2 = config.get(WITH_MS2)
     exclude_controls = config.get(EXCLUDE_CONTROLS)
+    # one array per column of the target table
+    ids = [str(target[0]) for target in targets]
+    mzs = [float(target[1]) for target in targets]
+    rts = [float(target[2]) for target in targets]
+    windows = [ppm_bounds(mz,ppm_diff) + rt_window(rt,rt_diff) for mz, rt in zip(mzs,rts)]
+    arrays = (ids,) + tuple(list(c) for c in zip(*windows)) + (mzs,rts)
+    if dialect == 'sqlite':
+        # no arrays, so the table is one row of values per target (see
+        # max_targets)
+        arrays = tuple(v for row in zip(*arrays) for v in row)
+        n_targets = len(targets)
+    else:
+        n_targets = True
     if not exclude_controls:
-        query = Environment().from_string(SIMPLE_SEARCH_TEMPLATE).render({
+        query = render(t.SIMPLE_SEARCH_TEMPLATE,{
+            'targets': n_targets,
             'with_ms2': with_ms2
         })
-        params = (ion_mode,mz,ppm_diff,rt,rt_diff)
+        params = arrays + (ion_mode,ppm_diff,rt_diff)
     else:
-        query = Environment().from_string(SEARCH_TEMPLATE).render({
+        query = render(t.SEARCH_TEMPLATE,{
+            'targets': n_targets,
             'attrs': attrs,
-            'ioc': ioc,
+            'pivot_attrs': [a for a in attrs if pivot_attrs is None or a in pivot_attrs],
+            'by_exp': by_exp,
+            'ioc': ioc is not None,
             'with_ms2': with_ms2
         })
         if ioc is not None:
-            params = (ion_mode,mz,ppm_diff,rt,rt_diff,ioc)
+            params = arrays + (ion_mode,ppm_diff,rt_diff,ioc)
         else:
-            params = (ion_mode,mz,ppm_diff,rt,rt_diff)
+            params = arrays + (ion_mode,ppm_diff,rt_diff)
     return query, params
 
-def construct_match(exp_name,ion_mode,config):
+def match_window(config):
+    """the window around each metabolite that the match templates look
+    for matches in, as factors of its m/z, and with a rounding margin
+    relative to its rt (see sql_templates.SIMPLE_MATCH_TEMPLATE)"""
+    ppm_diff = config.get(PPM_DIFF)
+    rt_diff = config.get(RT_DIFF)
+    return ppm_window(1.0,ppm_diff) + (rt_diff,EPSILON,rt_diff,EPSILON)
+
+def construct_match(exp_name,ion_mode,config,pivot_attrs=None,by_exp=False,dialect='postgresql'):
+    """see construct_search"""
+    t = dialect_templates(dialect)
     ppm_diff = config.get(PPM_DIFF)
     rt_diff = config.get(RT_DIFF)
     ioc = config.get(INT_OVER_CONTROLS)
     attrs = config.get(ATTRS)
     with_ms2 = config.get(WITH_MS2)
     exclude_controls = config.get(EXCLUDE_CONTROLS)
+    window = match_window(config)
     if not exclude_controls:
-        query = Environment().from_string(SIMPLE_MATCH_TEMPLATE).render({
+        query = render(t.SIMPLE_MATCH_TEMPLATE,{
             'with_ms2': with_ms2
         })
-        params = (ion_mode,exp_name,ion_mode,ppm_diff,rt_diff)
+        params = (ion_mode,exp_name) + window + (ppm_diff,rt_diff,ion_mode)
     else:
-        query = Environment().from_string(MATCH_TEMPLATE).render({
+        query = render(t.MATCH_TEMPLATE,{
             'attrs': attrs,
-            'ioc': ioc,
+            'pivot_attrs': [a for a in attrs if pivot_attrs is None or a in pivot_attrs],
+            'by_exp': by_exp,
+            'ioc': ioc is not None,
             'with_ms2': with_ms2
         })
         if ioc is not None:
-            params = (ion_mode,exp_name,ioc,ion_mode,ppm_diff,rt_diff)
+            params = (ion_mode,exp_name,ioc) + window + (ppm_diff,rt_diff,ion_mode)
         else:
-            params = (ion_mode,exp_name,ion_mode,ppm_diff,rt_diff)
+            params = (ion_mode,exp_name) + window + (ppm_diff,rt_diff,ion_mode)
     return query, params
 
-def search(engine,mz,rt,ion_mode,config):
-    """returns ResultProxy"""
-    c = engine.connect()
-    query, params = construct_search(mz,rt,ion_mode,config)
-    return c.execute(query,*params)
+def read_targets(path):
+    """read (target id, mz, rt) from a CSV file with mz and rt columns
+    and optionally an id, target, or name column. targets with no id
+    are numbered by row"""
+    targets = []
+    with open(path,'rU') as f:
+        for n, d in enumerate(csv.DictReader(f)):
+            id = d.get('id') or d.get('target') or d.get('name') or str(n+1)
+            targets.append((id, float(d['mz']), float(d['rt'])))
+    return targets
+
+def result_attrs(c,ion_mode,window=None,exps=None):
+    """names of the sample attributes of the experiments in ion_mode,
+    or only of those with metabolites in the window (mz lower bound,
+    mz upper bound, rt lower bound, rt upper bound), or only of the
+    experiments with ids exps"""
+    context = {
+        'window': window is not None
+    }
+    if window is not None:
+        params = (ion_mode,) + window
+    elif exps is not None:
+        if not exps:
+            return []
+        context['exps'] = len(exps) if c.dialect.name == 'sqlite' else True
+        params = (ion_mode,) + (tuple(exps) if c.dialect.name == 'sqlite' else (list(exps),))
+    else:
+        params = (ion_mode,)
+    query = render(templates(c).ATTR_NAMES_TEMPLATE,context)
+    return [row[0] for row in c.execute(query,[params]) if row[0] != 'ignore']
+
+def target_exps(c,targets,config):
+    """ids of the experiments with metabolites in the window of any of
+    targets, a list of (target id, mz, rt), for result_attrs"""
+    t = templates(c)
+    ppm_diff = config.get(PPM_DIFF)
+    rt_diff = config.get(RT_DIFF)
+    windows = [ppm_bounds(float(mz),ppm_diff) + rt_window(float(rt),rt_diff) for _, mz, rt in targets]
+    n = max_targets(c.engine) or max(len(windows),1)
+    exps = set()
+    for k in range(0,len(windows),n):
+        batch = windows[k:k+n]
+        if c.dialect.name == 'sqlite':
+            params = tuple(v for w in batch for v in w)
+        else:
+            params = tuple(list(col) for col in zip(*batch))
+        query = render(t.TARGET_EXPS_TEMPLATE,{'targets': len(batch)})
+        exps.update(row[0] for row in c.execute(query,[params]))
+    return sorted(exps)
 
-def match(engine,exp_name,ion_mode,config):
+def match_exps(c,exp_name,ion_mode,config):
+    """ids of the experiment exp_name and of the experiments with
+    metabolites in the window of any of its metabolites, for
+    result_attrs"""
+    params = (ion_mode,exp_name) + match_window(config) + (ion_mode,exp_name)
+    return sorted(row[0] for row in c.execute(templates(c).MATCH_EXPS_TEMPLATE,[params]))
+
+def explain(c,query,params):
+    """the plan of query, as lines of text. on PostgreSQL the query is
+    run to get it (see sql_templates.EXPLAIN)"""
+    return [row[-1] for row in c.execute(templates(c).EXPLAIN + query,[params])]
+
+def stream_csv(engine,construct,ion_mode,window=None,prepared=False,exps=None,profile=None):
+    """run the query that construct returns given the pivot attrs,
+    whether intensity has an exp_id column and the dialect, and stream
+    its results as CSV lines. construct may be a list, whose queries
+    are run in turn and their results streamed under one header. only
+    the plan of the first is captured. the attribute columns are
+    determined before the query runs (see result_attrs for window and
+    exps, which may be a function of the connection that returns them),
+    and rows are fetched FETCH_SIZE at a time from a server-side cursor, so
+    memory use does not depend on the number of results. a prepared
+    query cannot be run on a server-side cursor, so prepared is for
+    queries with few results. the time of each phase is recorded in
+    profile, if given. on a server-side cursor most of the work of the
+    query is done as rows are fetched, not when it is executed"""
+    if profile is None:
+        profile = Profile()
     c = engine.connect()
-    query, params = construct_match(exp_name,ion_mode,config)
-    return c.execute(query,*params)
+    try:
+        with profile.phase('metadata'):
+            pivot_attrs, by_exp = pivot_columns(c), intensity_by_exp(c)
+            if callable(exps):
+                exps = exps(c)
+            attrs = result_attrs(c,ion_mode,window,exps)
+        constructs = construct if isinstance(construct,list) else [construct]
+        for n, construct in enumerate(constructs):
+            with profile.phase('render'):
+                query, params = construct(pivot_attrs,by_exp,c.dialect.name)
+            if profile.explain and not n:
+                profile.query = query
+                with profile.phase('explain'):
+                    profile.plan = explain(c,query,params)
+            with profile.phase('execute'):
+                if prepared:
+                    r = execute_prepared(c,query,params)
+                else:
+                    r = c.execution_options(stream_results=True).execute(query,[params])
+            for line in results_as_csv(r,attrs,profile,header=not n):
+                yield line
+    finally:
+        c.close()
+
+def cache_key(engine,query,ion_mode,config):
+    """what identifies the results of a query (the kind of query and
+    its args) in a ResultCache. only the config that the results depend
+    on is included, normalized so that equivalent configs are equal"""
+    exclude_controls = bool(config.get(EXCLUDE_CONTROLS))
+    ioc = config.get(INT_OVER_CONTROLS)
+    return (repr(engine.url), ion_mode) + query + (
+        float(config.get(PPM_DIFF)),
+        float(config.get(RT_DIFF)),
+        bool(config.get(WITH_MS2)),
+        exclude_controls,
+        float(ioc) if exclude_controls and ioc is not None else None,
+        tuple(sorted(set(config.get(ATTRS) or []))) if exclude_controls else ()
+    )
+
+def cached_csv(engine,cache,query,ion_mode,config,lines,profile=None):
+    """the CSV lines of a query's results from cache (see cache.py), or
+    else from lines(), which are added to the cache as they stream. if
+    cache is None, just lines(). a query whose plan is wanted (see
+    stream_csv) is always run"""
+    if cache is None:
+        return lines()
+    return _cached_csv(engine,cache,cache_key(engine,query,ion_mode,config),lines,profile)
+
+def _cached_csv(engine,cache,key,lines,profile):
+    if profile is None:
+        profile = Profile()
+    with profile.phase('cache'):
+        c = engine.connect()
+        try:
+            generation = data_generation(c)
+        finally:
+            c.close()
+        hit = None if profile.explain else cache.get(key,generation)
+    if hit is not None:
+        for n, line in enumerate(hit):
+            if n: # not the header
+                profile.rows += 1
+            yield line
+        return
+    writer = cache.writer(key,generation)
+    try:
+        for line in lines():
+            writer.add(line)
+            yield line
+    except:
+        writer.abort()
+        raise
+    else:
+        writer.commit()
+
+def search_csv(engine,mz,rt,ion_mode,config,snapshot=None,cache=None,profile=None):
+    """stream search results as CSV lines. if a snapshot of ion_mode is
+    given (see snapshot.py), the metabolites in the window are found in
+    it, and only their ids go to the database. if a ResultCache is
+    given, results are looked up in it first. see stream_csv for
+    profile"""
+    def lines():
+        if snapshot is not None:
+            with (profile or Profile()).phase('snapshot'):
+                ids, exps = snapshot.search(mz,rt,config.get(PPM_DIFF),config.get(RT_DIFF),config.get(WITH_MS2))
+            construct = lambda pivot_attrs, by_exp, dialect: construct_search(mz,rt,ion_mode,config,pivot_attrs,by_exp,dialect,ids)
+            return stream_csv(engine,construct,ion_mode,exps=exps,prepared=True,profile=profile)
+        construct = lambda pivot_attrs, by_exp, dialect: construct_search(mz,rt,ion_mode,config,pivot_attrs,by_exp,dialect)
+        window = ppm_bounds(mz,config.get(PPM_DIFF)) + rt_window(rt,config.get(RT_DIFF))
+        return stream_csv(engine,construct,ion_mode,window,prepared=True,profile=profile)
+    return cached_csv(engine,cache,('search',float(mz),float(rt)),ion_mode,config,lines,profile)
+
+def max_targets(engine):
+    """the most targets one query can search for, or None if there is no
+    limit. on PostgreSQL the targets are arrays, but on SQLite each is
+    TARGET_PARAMS params, and a query may have 32766 params (999 before
+    SQLite 3.32)"""
+    if engine.dialect.name != 'sqlite':
+        return None
+    if engine.dialect.dbapi.sqlite_version_info >= (3,32):
+        max_params = 32766
+    else:
+        max_params = 999
+    # less the ion mode, ppm, rt and ioc params
+    return (max_params - 4) // TARGET_PARAMS
+
+def search_targets_csv(engine,targets,ion_mode,config,cache=None,profile=None):
+    """stream search results for a list of targets as CSV lines. the
+    targets are searched for max_targets at a time"""
+    n = max_targets(engine) or max(len(targets),1)
+    batches = [targets[k:k+n] for k in range(0,max(len(targets),1),n)]
+    construct = [lambda pivot_attrs, by_exp, dialect, batch=batch: construct_target_search(batch,ion_mode,config,pivot_attrs,by_exp,dialect)
+                 for batch in batches]
+    exps = lambda c: target_exps(c,targets,config)
+    lines = lambda: stream_csv(engine,construct,ion_mode,exps=exps,profile=profile)
+    return cached_csv(engine,cache,('search_targets',tuple(targets)),ion_mode,config,lines,profile)
+
+def match_csv(engine,exp_name,ion_mode,config,cache=None,profile=None):
+    """stream match results as CSV lines"""
+    construct = lambda pivot_attrs, by_exp, dialect: construct_match(exp_name,ion_mode,config,pivot_attrs,by_exp,dialect)
+    exps = lambda c: match_exps(c,exp_name,ion_mode,config)
+    lines = lambda: stream_csv(engine,construct,ion_mode,exps=exps,profile=profile)
+    return cached_csv(engine,cache,('match',exp_name),ion_mode,config,lines,profile)
 
-def results_as_csv(r):
+def split_attrs(attrs):
+    """the name=value pairs of a result's attrs, which are an array, or
+    on SQLite a string"""
+    if not attrs:
+        return []
+    if isinstance(attrs, basestring):
+        return attrs.split(ATTR_SEPARATOR)
+    return attrs
+
+def row_as_csv(row,cols):
+    rd = dict(row.items())
+    # explode attrs
+    ad = dict([kv.split('=') for kv in split_attrs(rd['attrs'])])
+    del rd['attrs']
+    rd.update(ad) # FIXME avoid name collisions
+    return ','.join(format_value(rd.get(c,'')) for c in cols)
+
+def results_as_csv(r,attrs=None,profile=None,header=True):
+    """format results as CSV lines, with one column per sample attribute.
+    if the attribute names are not given, all rows are fetched first to
+    find them. if they are, the time spent fetching and formatting rows
+    is recorded in profile, if given, and the header line can be left
+    out"""
+    if attrs is None:
+        return buffered_results_as_csv(r)
+    return streamed_results_as_csv(r,attrs,profile or Profile(),header)
+
+def streamed_results_as_csv(r,attrs,profile,header=True):
+    cols = [x for x in r.keys() if x != 'attrs'] + attrs
+    if header:
+        yield ','.join(cols)
+    while True:
+        with profile.phase('fetch'):
+            rows = r.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        # formatted a batch at a time, so that the time the lines take
+        # to be consumed is not counted
+        with profile.phase('format'):
+            lines = [row_as_csv(row,cols) for row in rows]
+        profile.rows += len(rows)
+        for line in lines:
+            yield line
+
+def buffered_results_as_csv(r):
     rows = r.fetchall()
     cols = [x for x in r.keys() if x != 'attrs']
     if not rows:
@@ -73,7 +432,7 @@ def results_as_csv(r):
     # determine column headings
     attrs = []
     for row in rows:
-        for kv in dict(row.items()).get('attrs'):
+        for kv in split_attrs(dict(row.items()).get('attrs')):
             k, v = kv.split('=')
             if k not in attrs and k != 'ignore':
                 attrs += [k]
@@ -81,40 +440,4 @@ def results_as_csv(r):
     yield ','.join(cols)
     # now postprocess rows
     for row in rows:
-        rd = dict(row.items())
-        # explode attrs
-        ad = dict([kv.split('=') for kv in rd['attrs']])
-        del rd['attrs']
-        rd.update(ad) # FIXME avoid name collisions
-        yield ','.join(str(rd.get(c,'')) for c in cols)
-
-def test(engine):
-    cases = [
-        dict(mz=100,rt=90),
-        dict(mz=102,rt=90),
-        dict(mz=102,rt=200),
-        dict(mz=103,rt=100),
-        dict(mz=105,rt=80,ioc=10),
-        dict(mz=107,rt=200,attrs=['media']),
-        dict(mz=108,rt=100,attrs=['media']),
-        dict(mz=109,rt=500,attrs=['media','time']),
-        dict(mz=111,rt=500,attrs=['media','time']),
-        dict(mz=113,rt=100,attrs=['media'],ioc=10),
-        dict(mz=113,rt=200,attrs=['media'],ioc=10),
-        dict(mz=114,rt=100,attrs=['media'],ioc=10),
-        dict(mz=116,rt=100,attrs=['media','time'],ioc=10)
-    ]
-    for case in cases:
-        print case
-        r = search(engine,
-                   case.get('mz'),
-                   case.get('rt'),
-                   ioc=case.get('ioc'),
-                   attrs=case.get('attrs',[]))
-        for line in results_as_csv(r):
-            print line
-
-if __name__=='__main__':
-    engine = get_psql_engine()
-    test(engine)
-
+        yield row_as_csv(row,cols)
@@ -0,0 +1,50 @@
+import json
+import time
+from contextlib import contextmanager
+from collections import OrderedDict
+
+# where searches and matches spend their time (see new_search.stream_csv)
+# and a log of it, for the shell's timing and explain commands
+
+class Profile(object):
+    """wall time of each phase of a query in seconds, in the order the
+    phases first ran, and the number of result rows. if explain is
+    true, the rendered query and its plan are captured as well"""
+    def __init__(self, explain=False):
+        self.explain = explain
+        self.phases = OrderedDict()
+        self.rows = 0
+        self.query = None
+        self.plan = None
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - start
+    def describe(self):
+        return ', '.join('%s %.3f' % (name, seconds) for name, seconds in self.phases.items())
+
+class QueryLog(object):
+    """an append-only log of queries, one JSON object per line"""
+    def __init__(self, path):
+        self.path = path
+    def append(self, record):
+        # one write per record, so that shells sharing the log do not
+        # interleave their records
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+    def records(self):
+        try:
+            f = open(self.path)
+        except IOError:
+            return
+        with f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError: # cut short, by a full disk say
+                    continue
+    def slowest(self, n=10):
+        return sorted(self.records(), key=lambda r: r['seconds'], reverse=True)[:n]
@@ -0,0 +1,134 @@
+import os
+import json
+import shutil
+import time
+
+import numpy as np
+
+from kuj_orm import templates
+from utils import ppm_bounds, rt_window
+
+# a snapshot is the metabolite catalog of one ion mode (the id, exp_id,
+# mz, rt and withMS2 of every metabolite) written as one .npy file per
+# column, sorted by m/z. opening a snapshot memory-maps the files, so it
+# reads nothing, and a search reads only the pages its window falls in:
+# the window is found by binary search over mz and tested exactly, and
+# only the ids of the metabolites in it are sent to the database (see
+# new_search.search_csv). the catalog only changes when experiments are
+# added or removed, after which a snapshot has to be exported again
+
+FETCH_SIZE=50000 # rows per round trip when exporting
+
+# column names and types, in the order of SNAPSHOT_METABOLITES
+COLUMNS=[
+    ('id', np.int32),
+    ('exp_id', np.int32),
+    ('mz', np.float64),
+    ('rt', np.float64),
+    ('withMS2', np.int8)
+]
+
+META_FILE='snapshot.json'
+
+def snapshot_path(dir, ion_mode):
+    return os.path.join(dir, ion_mode)
+
+def exp_ids(c, ion_mode):
+    """ids of the experiments in ion_mode. a snapshot is current if it
+    was exported when there were the same experiments"""
+    return [row[0] for row in c.execute(templates(c).SNAPSHOT_EXPERIMENTS, ion_mode)]
+
+def export_snapshot(engine, dir, ion_mode, log=None):
+    """write a snapshot of the metabolites in ion_mode to dir, replacing
+    the one there. it is written next to it and then moved into place,
+    so searches never see a partly written snapshot. returns number of
+    metabolites"""
+    if log is None:
+        log = lambda _: None
+    path = snapshot_path(dir, ion_mode)
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    c = engine.connect()
+    try:
+        t = templates(c)
+        # read before the metabolites, so that an experiment added or
+        # removed meanwhile makes the snapshot out of date, not wrong
+        exps = exp_ids(c, ion_mode)
+        # each batch of rows becomes arrays as it arrives
+        chunks = dict((name, []) for name, _ in COLUMNS)
+        n = 0
+        r = c.execution_options(stream_results=True).execute(t.SNAPSHOT_METABOLITES, ion_mode)
+        while True:
+            rows = r.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for i, (name, dtype) in enumerate(COLUMNS):
+                chunks[name].append(np.array([row[i] for row in rows], dtype=dtype))
+            n += len(rows)
+            log('read %d metabolites' % n)
+    finally:
+        c.close()
+    columns = {}
+    for name, dtype in COLUMNS:
+        columns[name] = np.concatenate(chunks.pop(name) or [np.zeros(0, dtype)])
+    log('sorting %d metabolites from %d experiments' % (len(columns['id']), len(exps)))
+    # sorting here instead of in the database avoids a sort or an index
+    # scan of the whole metabolite table
+    order = np.lexsort((columns['id'], columns['mz']))
+    for name, _ in COLUMNS:
+        np.save(os.path.join(tmp, name + '.npy'), columns[name][order])
+    with open(os.path.join(tmp, META_FILE), 'w') as f:
+        json.dump({
+            'ion_mode': ion_mode,
+            'metabolites': len(order),
+            'experiments': exps,
+            'exported': time.strftime('%Y-%m-%d %H:%M:%S')
+        }, f)
+    # searches that have the old snapshot open keep reading its files
+    if os.path.exists(path):
+        os.rename(path, path + '.old')
+        os.rename(tmp, path)
+        shutil.rmtree(path + '.old')
+    else:
+        os.rename(tmp, path)
+    return len(order)
+
+def open_snapshot(dir, ion_mode):
+    """the snapshot of ion_mode in dir, or None if there is none"""
+    if not os.path.exists(os.path.join(snapshot_path(dir, ion_mode), META_FILE)):
+        return None
+    return Snapshot(dir, ion_mode)
+
+class Snapshot(object):
+    """a snapshot, memory-mapped. has one array per column"""
+    def __init__(self, dir, ion_mode):
+        path = snapshot_path(dir, ion_mode)
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        for name, _ in COLUMNS:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+    def __len__(self):
+        return len(self.id)
+    def is_current(self, c):
+        """whether the database has the experiments the snapshot was
+        exported from, and no others"""
+        return exp_ids(c, self.meta['ion_mode']) == self.meta['experiments']
+    def search(self, mz, rt, ppm_diff, rt_diff, with_ms2=False):
+        """ids of the metabolites within ppm_diff of mz and rt_diff of rt,
+        tested as in the search templates, and of the experiments with
+        metabolites within the bounds of that window, which are the
+        ones new_search.result_attrs finds. both are lists"""
+        lo, hi = ppm_bounds(mz, ppm_diff)
+        left = np.searchsorted(self.mz, lo, side='left')
+        right = np.searchsorted(self.mz, hi, side='right')
+        m, r = self.mz[left:right], self.rt[left:right]
+        rt_lo, rt_hi = rt_window(rt, rt_diff)
+        in_bounds = (r >= rt_lo) & (r <= rt_hi)
+        keep = in_bounds & (1e6 * np.abs(m - mz) <= ppm_diff * m) & (np.abs(r - rt) <= rt_diff)
+        if with_ms2:
+            keep &= self.withMS2[left:right] == 1
+        ids = self.id[left:right][keep]
+        exps = np.unique(self.exp_id[left:right][in_bounds])
+        return ids.tolist(), exps.tolist()
@@ -1,19 +1,62 @@
 # search that does not exclude controls
 # positional SQL params
 # 1. ion mode
-# 2. m/z ratio
-# 3. m/z ppm range
-# 4. retention time
-# 5. rt range
+# 2. m/z lower bound
+# 3. m/z upper bound
+# 4. rt lower bound
+# 5. rt upper bound
+# 6. m/z ratio
+# 7. m/z ppm range
+# 8. retention time
+# 9. rt range
+# the bounds (see utils.ppm_bounds and utils.rt_window) allow an index
+# range scan on (mz, rt); the exact ppm/rt test is applied to what
+# falls within them
+# when searching for a list of targets, params 2-9 are replaced by
+# 1. target ids
+# 2. m/z lower bounds
+# 3. m/z upper bounds
+# 4. rt lower bounds
+# 5. rt upper bounds
+# 6. m/z ratios
+# 7. retention times
+# (arrays, one element per target) followed by
+# 8. ion mode
+# 9. m/z ppm range
+# 10. rt range
+# when the ids of the metabolites in the window are already known (see
+# snapshot.Snapshot.search), params 1-9 are replaced by
+# 1. metabolite ids (an array)
 # template params
+# targets: T or F whether to search for a list of targets
+# ids: T or F whether to search for given metabolite ids
 # with_ms2: T or F whether to require with_ms2 to be true
 SIMPLE_SEARCH_TEMPLATE="""
+{% if targets %}
+select t.target_id, match_exp, match_mz, match_rt, match_annotated, "match_withMS2", sample, intensity, control, attrs
+from unnest(%s, %s, %s, %s, %s, %s, %s) as t(target_id, mz_lo, mz_hi, rt_lo, rt_hi, mz, rt),
+     mtab_sample_attr msa
+where intensity > 0
+and ion_mode = %s
+and match_mz between t.mz_lo and t.mz_hi
+and match_rt between t.rt_lo and t.rt_hi
+and 1e6 * abs(match_mz - t.mz) <= %s * match_mz
+and abs(match_rt - t.rt) <= %s
+{% elif ids %}
+select match_exp, match_mz, match_rt, match_annotated, "match_withMS2", sample, intensity, control, attrs
+from mtab_sample_attr msa
+where intensity > 0
+and mtab_id = any(%s)
+{% else %}
 select match_exp, match_mz, match_rt, match_annotated, "match_withMS2", sample, intensity, control, attrs
 from mtab_sample_attr msa
 where intensity > 0
 and ion_mode = %s
+and match_mz between %s and %s
+and match_rt between %s and %s
 and 1e6 * abs(match_mz - %s) <= %s * match_mz
 and abs(match_rt - %s) <= %s
+{% endif %}
 {% if with_ms2 %}
 and "match_withMS2"=1
 {% endif %}
@@ -22,50 +65,106 @@ and "match_withMS2"=1
 # search that excludes controls
 # positional SQL params
 # 1. ion mode
-# 2. m/z ratio
-# 3. m/z ppm range
-# 4. retention time
-# 5. rt range
-# 6. intensity over controls (for some queries)
+# 2. m/z lower bound
+# 3. m/z upper bound
+# 4. rt lower bound
+# 5. rt upper bound
+# 6. m/z ratio
+# 7. m/z ppm range
+# 8. retention time
+# 9. rt range
+# 10. intensity over controls (for some queries)
+# when searching for a list of targets, params 1-9 are replaced by the
+# target arrays, ion mode, m/z ppm range and rt range as in
+# SIMPLE_SEARCH_TEMPLATE, and when the ids of the metabolites in the
+# window are already known, by the array of metabolite ids
 # template params
+# targets: T or F whether to search for a list of targets
+# ids: T or F whether to search for given metabolite ids
 # attrs: names of sample attrs to group by (for some queries)
+# pivot_attrs: names of the attrs that have a sample_attr_pivot column;
+# other attrs are null for every sample
+# by_exp: T or F whether intensity has an exp_id column (see
+# kuj_orm.intensity_by_exp), in which case it is joined on exp_id too so
+# that only the experiments' partitions or packed rows are read
 # ioc: None if not using ioc but just excluding controls, some Truey value otherwise
 # with_ms2: T or F whether to require with_ms2 to be true
 SEARCH_TEMPLATE="""
 with
-q0 as (select m.id from metabolite m, experiment e
+{% if targets %}
+q0 as (select t.target_id, m.id, m.exp_id
+       from unnest(%s, %s, %s, %s, %s, %s, %s) as t(target_id, mz_lo, mz_hi, rt_lo, rt_hi, mz, rt),
+            metabolite m, experiment e
+       where e.id=m.exp_id and e.ion_mode=%s
+       and m.mz between t.mz_lo and t.mz_hi
+       and m.rt between t.rt_lo and t.rt_hi
+       and 1e6 * abs(m.mz - t.mz) <= %s * m.mz
+       and abs(m.rt - t.rt) <= %s),
+{% elif ids %}
+q0 as (select m.id, m.exp_id from metabolite m
+       where m.id = any(%s)),
+{% else %}
+q0 as (select m.id, m.exp_id from metabolite m, experiment e
        where e.id=m.exp_id and e.ion_mode=%s
+       and m.mz between %s and %s
+       and m.rt between %s and %s
        and 1e6 * abs(m.mz - %s) <= %s * m.mz
        and abs(m.rt - %s) <= %s),
+{% endif %}
 
+{% if attrs %}
 q1 as (select mtab_id, i.sample_id, intensity, control{% for a in attrs %},
-             (select value from sample_attr sa where sa.sample_id=i.sample_id and sa.name='{{a}}') as attr_{{a}}{% endfor %}
-       from intensity i, sample s, q0
-       where mtab_id=q0.id and i.sample_id = s.id),
+             {% if a in pivot_attrs %}p."{{a}}"{% else %}null::text{% endif %} as attr_{{a}}{% endfor %}
+       from intensity i, sample s, sample_attr_pivot p
+{% if by_exp %}
+       where (mtab_id, i.exp_id) in (select id, exp_id from q0)
+{% else %}
+       where mtab_id in (select id from q0)
+{% endif %}
+       and i.sample_id = s.id
+       and p.sample_id = s.id),
 
 q2 as (select mtab_id{% for a in attrs %}, attr_{{a}}{% endfor %}, avg(intensity) as iic
        from q1
        where control=1
        group by mtab_id{% for a in attrs %}, attr_{{a}}{% endfor %}),
 
-q3 as (select mtab_id, sample_id
-       from q1
+q3 as (select q1.mtab_id, q1.sample_id
+       from q1 join q2 on q1.mtab_id=q2.mtab_id{% for a in attrs %}
+       and q1.attr_{{a}} is not distinct from q2.attr_{{a}}{% endfor %}
        where control=0
 {% if ioc %}
-       and intensity > %s * (select iic from q2 where q1.mtab_id=q2.mtab_id{% for a in attrs %}
-                             and q1.attr_{{a}} is not distinct from q2.attr_{{a}}{% endfor %})
+       and intensity > %s * q2.iic
 {% else %}
        and intensity > 0
-       and 0 = (select iic from q2 where q1.mtab_id=q2.mtab_id{% for a in attrs %}
-                and q1.attr_{{a}} is not distinct from q2.attr_{{a}}{% endfor %})
+       and 0 = q2.iic
+{% endif %}
+       order by q1.mtab_id, q1.sample_id)
+{% else %}
+-- ungrouped, so the control average comes from mtab_summary and
+-- samples only need to be above the threshold
+q3 as (select mtab_id, threshold
+       from (select mtab_id, avg_int_controls, max_int_samples,
+                    {% if ioc %}%s * avg_int_controls{% else %}avg_int_controls{% endif %} as threshold
+             from mtab_summary
+             where mtab_id in (select id from q0)) ms
+       where max_int_samples > threshold{% if not ioc %}
+       and avg_int_controls = 0{% endif %})
 {% endif %}
-       order by mtab_id, sample_id)
 
 -- friendly output
-select match_exp, match_mz, match_rt, match_annotated, "match_withMS2", sample, intensity, control, attrs
-from mtab_sample_attr msa, q3
+select {% if targets %}q0.target_id, {% endif %}match_exp, match_mz, match_rt, match_annotated, "match_withMS2", sample, intensity, control, attrs
+from mtab_sample_attr msa, q3{% if targets %}, q0{% endif %}
 where msa.mtab_id=q3.mtab_id
+{% if attrs %}
 and msa.sample_id=q3.sample_id
+{% else %}
+and control=0
+and intensity > q3.threshold
+{% endif %}
+{% if targets %}
+and q0.id=q3.mtab_id
+{% endif %}
 {% if with_ms2 %}
 and "match_withMS2"=1
 {% endif %}
@@ -74,9 +173,19 @@ and "match_withMS2"=1
 # positional SQL params
 # 1. ion mode
 # 2. name of experiment to match from
-# 3. ion mode
-# 4. m/z ppm range
+# 3. factor of a's m/z below which b's is out of range
+# 4. factor of a's m/z above which b's is out of range
 # 5. rt range
+# 6. relative rounding margin for the rt window
+# 7. rt range
+# 8. relative rounding margin for the rt window
+# 9. m/z ppm range
+# 10. rt range
+# 11. ion mode
+# the matching metabolites are found by an index range scan on (mz, rt)
+# over the window around each metabolite, and then tested exactly. the
+# window is widened as utils.ppm_window and utils.rt_window widen theirs,
+# so rounding never leaves out a pair that passes the exact test
 # template params
 # with_ms2: T or F whether to require with_ms2 to be true
 SIMPLE_MATCH_TEMPLATE="""
@@ -87,13 +196,17 @@ q1 as (select mtab_id, i.sample_id
        and i.sample_id = s.id),
 
 q2 as (select a.id, b.id as match_id
-       from metabolite a, metabolite b, experiment e
+       from metabolite a, experiment e,
+       lateral (select id, exp_id from metabolite b
+                where b.mz between a.mz * %s and a.mz * %s
+                and b.rt between a.rt - %s - abs(a.rt) * %s and a.rt + %s + abs(a.rt) * %s
+                and 1e6 * abs(a.mz - b.mz) <= %s * a.mz
+                and abs(a.rt - b.rt) <= %s
+                offset 0) b -- keeps this a per-metabolite index range scan
        where a.id in (select mtab_id from q1)
        and a.id <> b.id
        and e.id=b.exp_id and e.ion_mode=%s
-       and b.id not in (select mtab_id from q1)
-       and 1e6 * abs(a.mz - b.mz) <= %s * a.mz
-       and abs(a.rt - b.rt) <= %s)
+       and not exists (select 1 from q1 where q1.mtab_id=b.id))
 
 -- friendly output
 select a.id, a.mz, a.rt,
@@ -111,48 +224,72 @@ and "match_withMS2"=1
 # 1. ion mode
 # 2. name of experiment to match from
 # 3. (optional) ioc
-# 4. ion mode
-# 5. m/z ppm range
-# 6. rt range
+# 4-9. the window, as 3-8 of SIMPLE_MATCH_TEMPLATE
+# 10. m/z ppm range
+# 11. rt range
+# 12. ion mode
 # template params
 # attrs: names of sample attrs to group by (for some queries)
+# pivot_attrs: names of the attrs that have a sample_attr_pivot column;
+# other attrs are null for every sample
+# by_exp: T or F whether intensity has an exp_id column (see
+# kuj_orm.intensity_by_exp), in which case it is joined on exp_id too so
+# that only the experiments' partitions or packed rows are read
 # ioc: None if not using ioc but just excluding controls, some Truey value otherwise
 # with_ms2: T or F whether to require with_ms2 to be true
 MATCH_TEMPLATE="""
 with
+{% if attrs %}
 q1 as (select mtab_id, i.sample_id, intensity, control{% for a in attrs %},
-             (select value from sample_attr sa where sa.sample_id=i.sample_id and sa.name='{{a}}') as attr_{{a}}{% endfor %}
-       from intensity i, sample s
+             {% if a in pivot_attrs %}p."{{a}}"{% else %}null::text{% endif %} as attr_{{a}}{% endfor %}
+       from intensity i, sample s, sample_attr_pivot p
        where s.exp_id=(select id from experiment where ion_mode=%s and name=%s)
-       and i.sample_id = s.id),
+       and i.sample_id = s.id{% if by_exp %}
+       and i.exp_id = s.exp_id{% endif %}
+       and p.sample_id = s.id),
 
 q2 as (select mtab_id{% for a in attrs %}, attr_{{a}}{% endfor %}, avg(intensity) as iic
        from q1
        where control=1
        group by mtab_id{% for a in attrs %}, attr_{{a}}{% endfor %}),
 
-q3 as (select mtab_id
-       from q1
+q3 as (select q1.mtab_id
+       from q1 join q2 on q1.mtab_id=q2.mtab_id{% for a in attrs %}
+       and q1.attr_{{a}} is not distinct from q2.attr_{{a}}{% endfor %}
        where control=0
 {% if ioc %}
-       and intensity > %s * (select iic from q2 where q1.mtab_id=q2.mtab_id{% for a in attrs %}
-                             and q1.attr_{{a}} is not distinct from q2.attr_{{a}}{% endfor %})
+       and intensity > %s * q2.iic
 {% else %}
        and intensity > 0
-       and 0 = (select iic from q2 where q1.mtab_id=q2.mtab_id{% for a in attrs %}
-                and q1.attr_{{a}} is not distinct from q2.attr_{{a}}{% endfor %})
+       and 0 = q2.iic
 {% endif %}
-       group by mtab_id
+       group by q1.mtab_id
        having count(*) > 0),
+{% else %}
+q3 as (select mtab_id
+       from mtab_summary
+       where exp_id=(select id from experiment where ion_mode=%s and name=%s)
+{% if ioc %}
+       and max_int_samples > %s * avg_int_controls
+{% else %}
+       and avg_int_controls = 0
+       and n_nonzero > 0
+{% endif %}
+       ),
+{% endif %}
 
 q4 as (select a.id, b.id as match_id
-       from metabolite a, metabolite b, experiment e
+       from metabolite a, experiment e,
+       lateral (select id, exp_id from metabolite b
+                where b.mz between a.mz * %s and a.mz * %s
+                and b.rt between a.rt - %s - abs(a.rt) * %s and a.rt + %s + abs(a.rt) * %s
+                and 1e6 * abs(a.mz - b.mz) <= %s * a.mz
+                and abs(a.rt - b.rt) <= %s
+                offset 0) b -- keeps this a per-metabolite index range scan
        where a.id in (select mtab_id from q3)
        and a.id <> b.id
        and e.id=b.exp_id and e.ion_mode=%s
-       and b.id not in (select mtab_id from q3)
-       and 1e6 * abs(a.mz - b.mz) <= %s * a.mz
-       and abs(a.rt - b.rt) <= %s)
+       and not exists (select 1 from q3 where q3.mtab_id=b.id))
 
 -- friendly output
 select a.id, a.mz, a.rt,
@@ -166,10 +303,109 @@ and "match_withMS2"=1
 {% endif %}
 """
 
-CREATE_VIEWS=["""
-create or replace view mtab_sample_attr
+# names of the sample attributes that results can have
+# positional SQL params
+# 1. ion mode
+# 2. m/z lower bound (if window)
+# 3. m/z upper bound (if window)
+# 4. rt lower bound (if window)
+# 5. rt upper bound (if window)
+# or
+# 2. experiment ids (if exps)
+# template params
+# window: T or F whether to only include experiments with metabolites
+# in the m/z and rt window
+# exps: T or F whether to only include the given experiments
+ATTR_NAMES_TEMPLATE="""
+select distinct sa.name
+from sample_attr sa, sample s, experiment e
+where sa.sample_id=s.id
+and s.exp_id=e.id
+and e.ion_mode=%s
+{% if window %}
+and e.id in (select m.exp_id from metabolite m
+             where m.mz between %s and %s
+             and m.rt between %s and %s)
+{% elif exps %}
+and e.id = any(%s)
+{% endif %}
+order by sa.name
+"""
+
+# ids of the experiments with metabolites in the window of any of a
+# list of targets, whose attributes are the columns of the results (see
+# new_search.target_exps)
+# positional SQL params
+# 1. m/z lower bounds
+# 2. m/z upper bounds
+# 3. rt lower bounds
+# 4. rt upper bounds
+# (arrays, one element per target)
+# template params
+# targets: number of targets
+TARGET_EXPS_TEMPLATE="""
+select distinct m.exp_id
+from unnest(%s, %s, %s, %s) as t(mz_lo, mz_hi, rt_lo, rt_hi),
+     lateral (select exp_id from metabolite m
+              where m.mz between t.mz_lo and t.mz_hi
+              and m.rt between t.rt_lo and t.rt_hi
+              offset 0) m
+"""
+
+# ids of the experiment matched from and of the experiments with
+# metabolites in the window of any of its metabolites, whose attributes
+# are the columns of the results (see new_search.match_exps)
+# positional SQL params
+# 1. ion mode
+# 2. name of experiment to match from
+# 3-8. the window, as 3-8 of SIMPLE_MATCH_TEMPLATE
+# 9. ion mode
+# 10. name of experiment to match from
+MATCH_EXPS_TEMPLATE="""
+select id from experiment where ion_mode=%s and name=%s
+union
+select b.exp_id
+from metabolite a, experiment e,
+     lateral (select exp_id from metabolite b
+              where b.mz between a.mz * %s and a.mz * %s
+              and b.rt between a.rt - %s - abs(a.rt) * %s and a.rt + %s + abs(a.rt) * %s
+              offset 0) b
+where a.exp_id=e.id
+and e.ion_mode=%s and e.name=%s
+"""
+
+# prefix of a search or match query for its plan. ANALYZE runs the
+# query, so the plan has actual times, row counts and buffer use
+EXPLAIN="""explain (analyze, buffers) """
+
+# the metabolite columns a snapshot holds (see snapshot.py). they are
+# sorted by m/z after they are read
+# positional SQL params
+# 1. ion mode
+SNAPSHOT_METABOLITES="""
+select m.id, m.exp_id, m.mz, m.rt, m."withMS2"
+from metabolite m, experiment e
+where e.id=m.exp_id and e.ion_mode=%s
+"""
+
+# experiments a snapshot is current with
+# positional SQL params
+# 1. ion mode
+SNAPSHOT_EXPERIMENTS="""
+select id from experiment where ion_mode=%s order by id
+"""
+
+# mtab_sample_attr_view joins each intensity with its metabolite,
+# sample, experiment and sample attributes. the mtab_sample_attr table
+# the templates query holds its nonzero rows (no query returns a zero
+# intensity) and is refreshed one experiment at a time with
+# REFRESH_MTAB_SAMPLE_ATTR when experiments are added or removed
+# template params
+# by_exp: T or F whether intensity has an exp_id column
+MTAB_SAMPLE_ATTR_VIEW_TEMPLATE="""
+create or replace view mtab_sample_attr_view
 as
-select m.id as mtab_id, s.id as sample_id,
+select m.id as mtab_id, s.id as sample_id, e.id as exp_id,
        e.name as match_exp,
        e.ion_mode,
        m.mz as match_mz, m.rt as match_rt, m.annotated as match_annotated, m."withMS2" as "match_withMS2",
@@ -179,6 +415,379 @@ select m.id as mtab_id, s.id as sample_id,
        (select array_agg(sa.name || '=' || sa.value) from sample_attr sa where sa.sample_id=s.id) as attrs
 from experiment e, sample s, metabolite m, intensity i
 where s.exp_id=e.id
-and i.sample_id=s.id
+and i.sample_id=s.id{% if by_exp %}
+and i.exp_id=s.exp_id{% endif %}
 and i.mtab_id=m.id
+"""
+
+# created after mtab_sample_attr_view
+CREATE_VIEWS=["""
+create table if not exists mtab_sample_attr
+as select * from mtab_sample_attr_view
+with no data
+""","""
+create index if not exists ix_msa_mtab_id on mtab_sample_attr (mtab_id)
+""","""
+create index if not exists ix_msa_sample_id on mtab_sample_attr (sample_id)
+""","""
+create index if not exists ix_msa_exp_id on mtab_sample_attr (exp_id)
+""","""
+create index if not exists ix_msa_mz_rt on mtab_sample_attr (match_mz, match_rt)
+"""]
+
+# earlier versions created mtab_sample_attr as a view
+MTAB_SAMPLE_ATTR_IS_VIEW="""
+select count(*) from pg_views where viewname='mtab_sample_attr'
+"""
+
+POPULATE_MTAB_SAMPLE_ATTR="""
+insert into mtab_sample_attr
+select * from mtab_sample_attr_view where intensity > 0
+"""
+
+# positional SQL params
+# 1. experiment id
+DELETE_MTAB_SAMPLE_ATTR="""
+delete from mtab_sample_attr where exp_id=%s
+"""
+
+# positional SQL params
+# 1. experiment id
+REFRESH_MTAB_SAMPLE_ATTR="""
+insert into mtab_sample_attr
+select * from mtab_sample_attr_view where exp_id=%s and intensity > 0
+"""
+
+# sample_attr_pivot has one row per sample with one text column per
+# sample attribute name, so that attribute-grouped queries join it
+# instead of looking up each attribute of each intensity. columns are
+# added as new attribute names are loaded (see kuj_orm.refresh_exp)
+CREATE_PIVOT="""
+create table if not exists sample_attr_pivot (
+    sample_id integer primary key,
+    exp_id integer not null
+)
+"""
+
+PIVOT_EXP_INDEX="""
+create index if not exists ix_sap_exp_id on sample_attr_pivot (exp_id)
+"""
+
+PIVOT_COLUMNS="""
+select column_name from information_schema.columns
+where table_name='sample_attr_pivot'
+and column_name not in ('sample_id','exp_id')
+"""
+
+# template params
+# col: quoted name of the column
+ADD_PIVOT_COLUMN_TEMPLATE="""
+alter table sample_attr_pivot add column if not exists {{col}} text
+"""
+
+# positional SQL params
+# 1. experiment id
+EXP_ATTR_NAMES="""
+select distinct sa.name
+from sample_attr sa, sample s
+where sa.sample_id=s.id
+and s.exp_id=%s
+"""
+
+# positional SQL params
+# 1. attribute name, once per attribute
+# 2. experiment id
+# template params
+# cols: quoted pivot column names of the attributes, in param order
+REFRESH_PIVOT_TEMPLATE="""
+insert into sample_attr_pivot (sample_id, exp_id{% for c in cols %}, {{c}}{% endfor %})
+select s.id, s.exp_id{% for c in cols %},
+       max(case when sa.name=%s then sa.value end){% endfor %}
+from sample s left join sample_attr sa on sa.sample_id=s.id
+where s.exp_id=%s
+group by s.id, s.exp_id
+"""
+
+# positional SQL params
+# 1. experiment id
+DELETE_PIVOT="""
+delete from sample_attr_pivot where exp_id=%s
+"""
+
+# mtab_summary holds, per metabolite, the mean and max intensity over
+# control samples (null if there are none) and the max intensity and
+# number of nonzero intensities over the other samples, for excluding controls
+# without aggregating intensities at query time. like mtab_sample_attr
+# it is refreshed one experiment at a time
+# positional SQL params
+# 1. experiment id
+DELETE_MTAB_SUMMARY="""
+delete from mtab_summary where exp_id=%s
+"""
+
+# positional SQL params
+# 1. experiment id
+# template params
+# by_exp: T or F whether intensity has an exp_id column
+REFRESH_MTAB_SUMMARY_TEMPLATE="""
+insert into mtab_summary (mtab_id, exp_id, avg_int_controls, max_int_samples, max_int_controls, n_nonzero)
+select i.mtab_id, s.exp_id,
+       avg(case when s.control=1 then i.intensity end),
+       max(case when s.control=0 then i.intensity end),
+       max(case when s.control=1 then i.intensity end),
+       count(case when s.control=0 and i.intensity > 0 then 1 end)
+from intensity i, sample s
+where i.sample_id=s.id{% if by_exp %}
+and i.exp_id=s.exp_id{% endif %}
+and s.exp_id=%s
+group by i.mtab_id, s.exp_id
+"""
+
+# exp_stats holds the number of samples and metabolites of each
+# experiment, for listing experiments without counting them
+# positional SQL params
+# 1. experiment id
+DELETE_EXP_STATS="""
+delete from exp_stats where exp_id=%s
+"""
+
+# positional SQL params
+# 1. experiment id
+REFRESH_EXP_STATS="""
+insert into exp_stats (exp_id, samples, metabolites)
+select e.id,
+       (select count(*) from sample s where s.exp_id=e.id),
+       (select count(*) from metabolite m where m.exp_id=e.id)
+from experiment e
+where e.id=%s
+"""
+
+# intensity partitioned by experiment, one partition per experiment
+# named intensity_<exp id> (see kuj_orm.partition_intensities). the
+# sequence is kept separate so that it survives replacing an
+# unpartitioned intensity table
+CREATE_PARTITIONED_INTENSITY=["""
+create sequence if not exists intensity_id_seq
+""","""
+create table intensity (
+    id integer not null default nextval('intensity_id_seq'),
+    sample_id integer references sample (id),
+    mtab_id integer references metabolite (id),
+    intensity real,
+    exp_id integer not null,
+    primary key (id, exp_id)
+) partition by list (exp_id)
+""","""
+alter sequence intensity_id_seq owned by intensity.id
+"""]
+
+# set aside an unpartitioned intensity table to be copied into a
+# partitioned one and dropped
+RENAME_UNPARTITIONED_INTENSITY=["""
+alter table intensity rename to intensity_unpartitioned
+""","""
+alter sequence intensity_id_seq owned by none
+""","""
+alter index intensity_pkey rename to intensity_unpartitioned_pkey
+""","""
+drop index if exists ix_intensity_mtab_id
+""","""
+drop index if exists ix_intensity_sample_id
+"""]
+
+# an experiment's partition is loaded as a table of its own and then
+# attached, which builds its indexes in one pass and does not lock the
+# intensity table while loading. the check constraint lets attaching
+# skip scanning the partition
+# template params
+# exp_id: experiment id
+CREATE_INTENSITY_PARTITION_TEMPLATE="""
+create table intensity_{{exp_id}} (
+    like intensity including defaults,
+    check (exp_id = {{exp_id}})
+)
+"""
+
+ATTACH_INTENSITY_PARTITION_TEMPLATE="""
+alter table intensity attach partition intensity_{{exp_id}} for values in ({{exp_id}})
+"""
+
+DROP_INTENSITY_PARTITION_TEMPLATE="""
+drop table if exists intensity_{{exp_id}}
+"""
+
+COUNT_INTENSITY_PARTITION_TEMPLATE="""
+select count(*) from intensity_{{exp_id}}
+"""
+
+INTENSITY_IS_PARTITIONED="""
+select count(*) from pg_partitioned_table pt, pg_class c
+where pt.partrelid=c.oid
+and c.relname='intensity'
+"""
+
+# positional SQL params
+# 1. experiment id
+COPY_UNPARTITIONED_INTENSITY_TEMPLATE="""
+insert into intensity_{{exp_id}} (id, sample_id, mtab_id, intensity, exp_id)
+select i.id, i.sample_id, i.mtab_id, i.intensity, s.exp_id
+from intensity_unpartitioned i, sample s
+where i.sample_id=s.id
+and s.exp_id=%s
+"""
+
+DROP_UNPARTITIONED_INTENSITY="""
+drop table intensity_unpartitioned
+"""
+
+# packed intensities have one row per metabolite with the indexes of
+# the samples where it has a nonzero intensity and those intensities,
+# as parallel arrays. a sample's index is its position in the
+# experiment's sample order, which intensity_sample records. zero
+# intensities are not stored
+CREATE_PACKED_INTENSITY=["""
+create table intensity_sample (
+    exp_id integer not null,
+    idx smallint not null,
+    sample_id integer not null references sample (id),
+    primary key (exp_id, idx)
+)
+""","""
+create table intensity_packed (
+    mtab_id integer primary key references metabolite (id),
+    exp_id integer not null,
+    sample_idx smallint[] not null,
+    intensities real[] not null
+)
+""","""
+create index ix_intensity_packed_exp_id on intensity_packed (exp_id)
+"""]
+
+# with packed intensities, intensity is a view that unpacks them with a
+# row, zero or not, for every sample of the metabolite's experiment, so
+# that queries see the same rows as with an intensity table. the id is
+# made up, but unique
+PACKED_INTENSITY_VIEW="""
+create or replace view intensity
+as
+select p.mtab_id::bigint * 65536 + d.idx as id, d.sample_id, p.mtab_id,
+       coalesce(d.intensity, 0) as intensity, p.exp_id
+from intensity_packed p,
+     lateral (select x.idx, x.sample_id, u.intensity
+              from intensity_sample x
+              left join unnest(p.sample_idx, p.intensities) as u(idx, intensity) on u.idx=x.idx
+              where x.exp_id=p.exp_id) d
+"""
+
+# converting an intensity table to packed intensities. samples are
+# numbered in id order, which is the order etl loads them in
+INDEX_INTENSITY_SAMPLES="""
+insert into intensity_sample (exp_id, idx, sample_id)
+select s.exp_id, row_number() over (partition by s.exp_id order by s.id), s.id
+from sample s
+where exists (select 1 from intensity i where i.sample_id=s.id)
+"""
+
+# positional SQL params
+# 1. experiment id
+PACK_INTENSITIES="""
+insert into intensity_packed (mtab_id, exp_id, sample_idx, intensities)
+select m.id, m.exp_id,
+       coalesce(array_agg(x.idx order by x.idx) filter (where i.intensity <> 0), '{}'),
+       coalesce(array_agg(i.intensity order by x.idx) filter (where i.intensity <> 0), '{}')
+from metabolite m, intensity i, intensity_sample x
+where i.mtab_id=m.id
+and x.sample_id=i.sample_id
+and m.exp_id=%s
+group by m.id, m.exp_id
+"""
+
+DROP_INTENSITY_TABLE=["""
+drop view mtab_sample_attr_view
+""","""
+drop table intensity
 """]
+
+# indexes that create_all does not add to tables that already exist
+CREATE_INDEXES=["""
+create index if not exists ix_metabolite_mz_rt on metabolite (mz, rt)
+""","""
+create index if not exists ix_metabolite_exp_id on metabolite (exp_id)
+""","""
+create index if not exists ix_sample_attr_sample_id on sample_attr (sample_id)
+"""]
+
+# the same for the intensity table, unless intensities are packed
+CREATE_INTENSITY_INDEXES=["""
+create index if not exists ix_intensity_mtab_id on intensity (mtab_id)
+""","""
+create index if not exists ix_intensity_sample_id on intensity (sample_id)
+"""]
+
+# schema migrations. initialize_schema applies those newer than the
+# database's schema_version in order (see kuj_orm.MIGRATIONS)
+
+# views have to be dropped to change the types of columns they select,
+# and are recreated by initialize_schema
+DROP_MTAB_SAMPLE_ATTR_VIEW="""
+drop view if exists mtab_sample_attr_view
+"""
+
+# 1. native floating point m/z, rt and intensity
+FLOAT_COLUMNS=["""
+alter table metabolite
+    alter column mz type double precision,
+    alter column mzmin type double precision,
+    alter column mzmax type double precision,
+    alter column rt type double precision,
+    alter column rtmin type double precision,
+    alter column rtmax type double precision
+""","""
+alter table mtab_summary
+    alter column avg_int_controls type double precision,
+    alter column max_int_samples type double precision
+"""]
+
+FLOAT_MTAB_SAMPLE_ATTR="""
+alter table mtab_sample_attr
+    alter column match_mz type double precision,
+    alter column match_rt type double precision,
+    alter column intensity type real
+"""
+
+# packed intensities are real already
+FLOAT_INTENSITY="""
+alter table intensity alter column intensity type real
+"""
+
+# 2. max control intensity in the intensity summary, after which
+# kuj_orm.migrate_max_int_controls refreshes the summary
+ADD_MAX_INT_CONTROLS="""
+alter table mtab_summary add column max_int_controls double precision
+"""
+
+# benchmarks of the arithmetic the search and match templates do on
+# m/z, rt and intensity, as stored and cast to other types (see
+# benchmark.py)
+# positional SQL params
+# 1. m/z ratio
+# 2. m/z ppm range
+# 3. retention time
+# 4. rt range
+# template params
+# type: SQL type to cast m/z and rt to
+BENCH_WINDOW_TEMPLATE="""
+select count(*)
+from (select mz::{{type}} as mz, rt::{{type}} as rt from metabolite) m
+where 1e6 * abs(m.mz - %s) <= %s * m.mz
+and abs(m.rt - %s) <= %s
+"""
+
+# template params
+# type: SQL type to cast intensity to
+BENCH_AVG_TEMPLATE="""
+select count(*), sum(iic)
+from (select mtab_id, avg(intensity::{{type}}) as iic
+      from intensity
+      group by mtab_id) q
+"""
@@ -0,0 +1,386 @@
+# SQLite versions of the templates in sql_templates that SQLite cannot
+# run as they are, for using a local database file instead of the
+# server. parameters are in the same order as in sql_templates, but
+# written ? (qmark) instead of %s, and each string is one statement.
+# m/z and rt windows are looked up in an R*Tree, metabolite_rtree, which
+# takes the place of the (mz, rt) index range scans. see
+# kuj_orm.templates for choosing between the modules
+
+from sql_templates import *
+
+def qmark(sql):
+    """the same SQL with qmark parameters"""
+    return sql.replace('%s', '?')
+
+# the R*Tree has a box per metabolite, of zero size. it stores 32-bit
+# floats, rounding lower bounds down and upper bounds up, so a query
+# for boxes overlapping a window finds every metabolite in it and a
+# few near it. the exact ppm/rt test is applied to those
+CREATE_RTREE="""
+create virtual table if not exists metabolite_rtree using rtree(id, mz_lo, mz_hi, rt_lo, rt_hi)
+"""
+
+POPULATE_RTREE="""
+insert or replace into metabolite_rtree (id, mz_lo, mz_hi, rt_lo, rt_hi)
+select id, mz, mz, rt, rt from metabolite
+"""
+
+# positional SQL params
+# 1. experiment id
+INDEX_METABOLITES="""
+insert or replace into metabolite_rtree (id, mz_lo, mz_hi, rt_lo, rt_hi)
+select id, mz, mz, rt, rt from metabolite where exp_id=?
+"""
+
+# the metabolites in the window (rtree r) come first, with CROSS JOIN,
+# so that each is looked up in mtab_sample_attr by index
+# positional SQL params as in sql_templates.SIMPLE_SEARCH_TEMPLATE.
+# when searching for a list of targets, the target arrays are replaced
+# by one row of (target id, m/z lower bound, m/z upper bound, rt lower
+# bound, rt upper bound, m/z ratio, retention time) per target, in order,
+# so a query can only have so many targets (see new_search.max_targets).
+# given metabolite ids are one param each
+# template params
+# targets: number of targets, if searching for a list of targets
+# ids: number of metabolite ids, if searching for given metabolite ids.
+# there may be none, which SQLite allows in an in list
+# with_ms2: T or F whether to require with_ms2 to be true
+SIMPLE_SEARCH_TEMPLATE="""
+{% if targets %}
+with t(target_id, mz_lo, mz_hi, rt_lo, rt_hi, mz, rt) as
+(values {% for n in range(targets) %}{% if n %}, {% endif %}(?, ?, ?, ?, ?, ?, ?){% endfor %})
+select t.target_id, match_exp, match_mz, match_rt, match_annotated, "match_withMS2", sample, intensity, control, attrs
+from t cross join metabolite_rtree r cross join mtab_sample_attr msa
+where intensity > 0
+and ion_mode = ?
+and r.mz_hi >= t.mz_lo and r.mz_lo <= t.mz_hi
+and r.rt_hi >= t.rt_lo and r.rt_lo <= t.rt_hi
+and msa.mtab_id = r.id
+and 1e6 * abs(match_mz - t.mz) <= ? * match_mz
+and abs(match_rt - t.rt) <= ?
+{% elif ids is defined %}
+select match_exp, match_mz, match_rt, match_annotated, "match_withMS2", sample, intensity, control, attrs
+from mtab_sample_attr msa
+where intensity > 0
+and mtab_id in ({% for n in range(ids) %}{% if n %}, {% endif %}?{% endfor %})
+{% else %}
+select match_exp, match_mz, match_rt, match_annotated, "match_withMS2", sample, intensity, control, attrs
+from metabolite_rtree r cross join mtab_sample_attr msa
+where ion_mode = ?
+and r.mz_hi >= ? and r.mz_lo <= ?
+and r.rt_hi >= ? and r.rt_lo <= ?
+and msa.mtab_id = r.id
+and intensity > 0
+and 1e6 * abs(match_mz - ?) <= ? * match_mz
+and abs(match_rt - ?) <= ?
+{% endif %}
+{% if with_ms2 %}
+and "match_withMS2"=1
+{% endif %}
+"""
+
+# positional SQL and template params as in sql_templates.SEARCH_TEMPLATE,
+# with targets and ids as in SIMPLE_SEARCH_TEMPLATE. intensity has no exp_id
+# column on SQLite, so by_exp does not apply
+SEARCH_TEMPLATE="""
+with
+{% if targets %}
+t(target_id, mz_lo, mz_hi, rt_lo, rt_hi, mz, rt) as
+(values {% for n in range(targets) %}{% if n %}, {% endif %}(?, ?, ?, ?, ?, ?, ?){% endfor %}),
+
+q0 as (select t.target_id, m.id, m.exp_id
+       from t cross join metabolite_rtree r cross join metabolite m, experiment e
+       where e.id=m.exp_id and e.ion_mode=?
+       and r.mz_hi >= t.mz_lo and r.mz_lo <= t.mz_hi
+       and r.rt_hi >= t.rt_lo and r.rt_lo <= t.rt_hi
+       and m.id = r.id
+       and 1e6 * abs(m.mz - t.mz) <= ? * m.mz
+       and abs(m.rt - t.rt) <= ?),
+{% elif ids is defined %}
+q0 as (select m.id, m.exp_id from metabolite m
+       where m.id in ({% for n in range(ids) %}{% if n %}, {% endif %}?{% endfor %})),
+{% else %}
+q0 as (select m.id, m.exp_id
+       from metabolite_rtree r cross join metabolite m, experiment e
+       where e.id=m.exp_id and e.ion_mode=?
+       and r.mz_hi >= ? and r.mz_lo <= ?
+       and r.rt_hi >= ? and r.rt_lo <= ?
+       and m.id = r.id
+       and 1e6 * abs(m.mz - ?) <= ? * m.mz
+       and abs(m.rt - ?) <= ?),
+{% endif %}
+
+{% if attrs %}
+q1 as (select mtab_id, i.sample_id, intensity, control{% for a in attrs %},
+             {% if a in pivot_attrs %}p."{{a}}"{% else %}cast(null as text){% endif %} as attr_{{a}}{% endfor %}
+       from intensity i, sample s, sample_attr_pivot p
+       where mtab_id in (select id from q0)
+       and i.sample_id = s.id
+       and p.sample_id = s.id),
+
+q2 as (select mtab_id{% for a in attrs %}, attr_{{a}}{% endfor %}, avg(intensity) as iic
+       from q1
+       where control=1
+       group by mtab_id{% for a in attrs %}, attr_{{a}}{% endfor %}),
+
+q3 as (select q1.mtab_id, q1.sample_id
+       from q1 join q2 on q1.mtab_id=q2.mtab_id{% for a in attrs %}
+       and q1.attr_{{a}} is q2.attr_{{a}}{% endfor %}
+       where control=0
+{% if ioc %}
+       and intensity > ? * q2.iic
+{% else %}
+       and intensity > 0
+       and 0 = q2.iic
+{% endif %}
+       order by q1.mtab_id, q1.sample_id)
+{% else %}
+q3 as (select mtab_id, threshold
+       from (select mtab_id, avg_int_controls, max_int_samples,
+                    {% if ioc %}? * avg_int_controls{% else %}avg_int_controls{% endif %} as threshold
+             from mtab_summary
+             where mtab_id in (select id from q0)) ms
+       where max_int_samples > threshold{% if not ioc %}
+       and avg_int_controls = 0{% endif %})
+{% endif %}
+
+select {% if targets %}q0.target_id, {% endif %}match_exp, match_mz, match_rt, match_annotated, "match_withMS2", sample, intensity, control, attrs
+from mtab_sample_attr msa, q3{% if targets %}, q0{% endif %}
+where msa.mtab_id=q3.mtab_id
+{% if attrs %}
+and msa.sample_id=q3.sample_id
+{% else %}
+and control=0
+and intensity > q3.threshold
+{% endif %}
+{% if targets %}
+and q0.id=q3.mtab_id
+{% endif %}
+{% if with_ms2 %}
+and "match_withMS2"=1
+{% endif %}
+"""
+
+# the metabolites around each metabolite a are looked up in the R*Tree,
+# which comes after a with CROSS JOIN, instead of with a lateral index
+# range scan
+# positional SQL and template params as in
+# sql_templates.SIMPLE_MATCH_TEMPLATE
+SIMPLE_MATCH_TEMPLATE="""
+with
+q1 as (select mtab_id, i.sample_id
+       from intensity i, sample s
+       where s.exp_id=(select id from experiment where ion_mode=? and name=?)
+       and i.sample_id = s.id),
+
+q2 as (select a.id, b.id as match_id
+       from metabolite a cross join metabolite_rtree r cross join metabolite b, experiment e
+       where a.id in (select mtab_id from q1)
+       and r.mz_hi >= a.mz * ? and r.mz_lo <= a.mz * ?
+       and r.rt_hi >= a.rt - ? - abs(a.rt) * ? and r.rt_lo <= a.rt + ? + abs(a.rt) * ?
+       and b.id = r.id
+       and 1e6 * abs(a.mz - b.mz) <= ? * a.mz
+       and abs(a.rt - b.rt) <= ?
+       and a.id <> b.id
+       and e.id=b.exp_id and e.ion_mode=?
+       and not exists (select 1 from q1 where q1.mtab_id=b.id))
+
+select a.id, a.mz, a.rt,
+       match_exp, match_mz, match_rt, match_annotated, "match_withMS2", sample, intensity, control, attrs
+from q2, metabolite a, mtab_sample_attr b
+where q2.id=a.id
+and intensity > 0
+and q2.match_id=b.mtab_id
+{% if with_ms2 %}
+and "match_withMS2"=1
+{% endif %}
+"""
+
+# positional SQL and template params as in sql_templates.MATCH_TEMPLATE,
+# except by_exp
+MATCH_TEMPLATE="""
+with
+{% if attrs %}
+q1 as (select mtab_id, i.sample_id, intensity, control{% for a in attrs %},
+             {% if a in pivot_attrs %}p."{{a}}"{% else %}cast(null as text){% endif %} as attr_{{a}}{% endfor %}
+       from intensity i, sample s, sample_attr_pivot p
+       where s.exp_id=(select id from experiment where ion_mode=? and name=?)
+       and i.sample_id = s.id
+       and p.sample_id = s.id),
+
+q2 as (select mtab_id{% for a in attrs %}, attr_{{a}}{% endfor %}, avg(intensity) as iic
+       from q1
+       where control=1
+       group by mtab_id{% for a in attrs %}, attr_{{a}}{% endfor %}),
+
+q3 as (select q1.mtab_id
+       from q1 join q2 on q1.mtab_id=q2.mtab_id{% for a in attrs %}
+       and q1.attr_{{a}} is q2.attr_{{a}}{% endfor %}
+       where control=0
+{% if ioc %}
+       and intensity > ? * q2.iic
+{% else %}
+       and intensity > 0
+       and 0 = q2.iic
+{% endif %}
+       group by q1.mtab_id
+       having count(*) > 0),
+{% else %}
+q3 as (select mtab_id
+       from mtab_summary
+       where exp_id=(select id from experiment where ion_mode=? and name=?)
+{% if ioc %}
+       and max_int_samples > ? * avg_int_controls
+{% else %}
+       and avg_int_controls = 0
+       and n_nonzero > 0
+{% endif %}
+       ),
+{% endif %}
+
+q4 as (select a.id, b.id as match_id
+       from metabolite a cross join metabolite_rtree r cross join metabolite b, experiment e
+       where a.id in (select mtab_id from q3)
+       and r.mz_hi >= a.mz * ? and r.mz_lo <= a.mz * ?
+       and r.rt_hi >= a.rt - ? - abs(a.rt) * ? and r.rt_lo <= a.rt + ? + abs(a.rt) * ?
+       and b.id = r.id
+       and 1e6 * abs(a.mz - b.mz) <= ? * a.mz
+       and abs(a.rt - b.rt) <= ?
+       and a.id <> b.id
+       and e.id=b.exp_id and e.ion_mode=?
+       and not exists (select 1 from q3 where q3.mtab_id=b.id))
+
+select a.id, a.mz, a.rt,
+       match_exp, match_mz, match_rt, match_annotated, "match_withMS2", sample, intensity, control, attrs
+from q4, metabolite a, mtab_sample_attr b
+where q4.id=a.id
+and intensity > 0
+and q4.match_id=b.mtab_id
+{% if with_ms2 %}
+and "match_withMS2"=1
+{% endif %}
+"""
+
+# python 2's sqlite3 only describes the columns of a result with no rows
+# if the statement starts with select, so the queries that start with a
+# with clause are wrapped in one
+def select_from(sql):
+    return 'select * from (%s)' % sql
+
+SIMPLE_SEARCH_TEMPLATE=select_from(SIMPLE_SEARCH_TEMPLATE)
+SEARCH_TEMPLATE=select_from(SEARCH_TEMPLATE)
+SIMPLE_MATCH_TEMPLATE=select_from(SIMPLE_MATCH_TEMPLATE)
+MATCH_TEMPLATE=select_from(MATCH_TEMPLATE)
+
+# positional SQL params as in sql_templates.ATTR_NAMES_TEMPLATE, with
+# one param per experiment id
+# template params
+# window: T or F whether to only include experiments with metabolites
+# in the m/z and rt window
+# exps: number of experiment ids, if only including those experiments
+ATTR_NAMES_TEMPLATE="""
+select distinct sa.name
+from sample_attr sa, sample s, experiment e
+where sa.sample_id=s.id
+and s.exp_id=e.id
+and e.ion_mode=?
+{% if window %}
+and e.id in (select m.exp_id from metabolite m
+             where m.mz between ? and ?
+             and m.rt between ? and ?)
+{% elif exps %}
+and e.id in ({% for n in range(exps) %}{% if n %}, {% endif %}?{% endfor %})
+{% endif %}
+order by sa.name
+"""
+
+# the target windows are one row of (m/z lower bound, m/z upper bound,
+# rt lower bound, rt upper bound) per target, looked up in the R*Tree
+# template params
+# targets: number of targets
+TARGET_EXPS_TEMPLATE=select_from("""
+with t(mz_lo, mz_hi, rt_lo, rt_hi) as
+(values {% for n in range(targets) %}{% if n %}, {% endif %}(?, ?, ?, ?){% endfor %})
+select distinct m.exp_id
+from t cross join metabolite_rtree r cross join metabolite m
+where r.mz_hi >= t.mz_lo and r.mz_lo <= t.mz_hi
+and r.rt_hi >= t.rt_lo and r.rt_lo <= t.rt_hi
+and m.id = r.id
+""")
+
+# positional SQL params as in sql_templates.MATCH_EXPS_TEMPLATE
+MATCH_EXPS_TEMPLATE="""
+select id from experiment where ion_mode=? and name=?
+union
+select b.exp_id
+from experiment e, metabolite a cross join metabolite_rtree r cross join metabolite b
+where r.mz_hi >= a.mz * ? and r.mz_lo <= a.mz * ?
+and r.rt_hi >= a.rt - ? - abs(a.rt) * ? and r.rt_lo <= a.rt + ? + abs(a.rt) * ?
+and b.id = r.id
+and a.exp_id=e.id
+and e.ion_mode=? and e.name=?
+"""
+
+# SQLite plans have neither times nor row counts
+EXPLAIN="""explain query plan """
+
+SNAPSHOT_METABOLITES=qmark(SNAPSHOT_METABOLITES)
+SNAPSHOT_EXPERIMENTS=qmark(SNAPSHOT_EXPERIMENTS)
+
+# attrs is a string of name=value pairs separated by ATTR_SEPARATOR
+# instead of an array (see new_search.split_attrs). the view is dropped
+# and created again instead of replaced
+# template params
+# by_exp: ignored
+MTAB_SAMPLE_ATTR_VIEW_TEMPLATE="""
+create view mtab_sample_attr_view
+as
+select m.id as mtab_id, s.id as sample_id, e.id as exp_id,
+       e.name as match_exp,
+       e.ion_mode,
+       m.mz as match_mz, m.rt as match_rt, m.annotated as match_annotated, m."withMS2" as "match_withMS2",
+       s.name as sample,
+       intensity,
+       control,
+       (select group_concat(sa.name || '=' || sa.value, char(31)) from sample_attr sa where sa.sample_id=s.id) as attrs
+from experiment e, sample s, metabolite m, intensity i
+where s.exp_id=e.id
+and i.sample_id=s.id
+and i.mtab_id=m.id
+"""
+
+ATTR_SEPARATOR='\x1f' # char(31)
+
+CREATE_VIEWS=["""
+create table if not exists mtab_sample_attr
+as select * from mtab_sample_attr_view
+where 0
+"""] + CREATE_VIEWS[1:]
+
+MTAB_SAMPLE_ATTR_IS_VIEW="""
+select count(*) from sqlite_master where type='view' and name='mtab_sample_attr'
+"""
+
+DELETE_MTAB_SAMPLE_ATTR=qmark(DELETE_MTAB_SAMPLE_ATTR)
+REFRESH_MTAB_SAMPLE_ATTR=qmark(REFRESH_MTAB_SAMPLE_ATTR)
+
+PIVOT_COLUMNS="""
+select name from pragma_table_info('sample_attr_pivot')
+where name not in ('sample_id','exp_id')
+"""
+
+# concurrent loads are serialized by SQLite's database lock, so the
+# column cannot have been added since it was looked for
+ADD_PIVOT_COLUMN_TEMPLATE="""
+alter table sample_attr_pivot add column {{col}} text
+"""
+
+EXP_ATTR_NAMES=qmark(EXP_ATTR_NAMES)
+REFRESH_PIVOT_TEMPLATE=qmark(REFRESH_PIVOT_TEMPLATE)
+DELETE_PIVOT=qmark(DELETE_PIVOT)
+
+DELETE_MTAB_SUMMARY=qmark(DELETE_MTAB_SUMMARY)
+REFRESH_MTAB_SUMMARY_TEMPLATE=qmark(REFRESH_MTAB_SUMMARY_TEMPLATE)
+
+DELETE_EXP_STATS=qmark(DELETE_EXP_STATS)
+REFRESH_EXP_STATS=qmark(REFRESH_EXP_STATS)
@@ -0,0 +1,137 @@
+import os
+import csv
+
+import numpy as np
+
+from kuj_orm import COMMON_FIELDS, FILE_NAME, CONTROL
+from utils import format_value
+
+# synthetic experiments for benchmarking (see benchmark.suite), written
+# as the data and metadata files that cli.list_exp_files and etl read.
+# some of each experiment's features are compounds shared with the
+# other experiments, scattered a little in m/z and rt, so that searches
+# and matches find a known proportion of features in several of them
+
+DISTRIBUTIONS=['uniform','normal']
+
+MZ_SCATTER=0.1 # sd of a shared compound's m/z between experiments, in ppm
+RT_SCATTER=5.0 # sd of a shared compound's rt between experiments, in seconds
+WITH_MS2=0.3 # fraction of features with MS2
+
+def default_spec():
+    return dict(
+        experiments = 4,
+        samples = 12, # per experiment
+        features = 2000, # per experiment
+        controls = 0.25, # fraction of samples that are controls
+        shared = 0.3, # fraction of features that are shared compounds
+        zeros = 0.5, # fraction of intensities that are zero
+        attrs = 2, # sample attributes besides control
+        mz_min = 100.0,
+        mz_max = 1000.0,
+        mz_dist = 'uniform',
+        rt_min = 60.0,
+        rt_max = 1500.0,
+        rt_dist = 'uniform',
+        seed = 1
+    )
+
+def str2fraction(s):
+    f = float(s)
+    if f < 0 or f > 1:
+        raise ValueError
+    return f
+
+def str2dist(s):
+    if s not in DISTRIBUTIONS:
+        raise ValueError
+    return s
+
+SPEC_CASTS = dict(
+    experiments=int,
+    samples=int,
+    features=int,
+    controls=str2fraction,
+    shared=str2fraction,
+    zeros=str2fraction,
+    attrs=int,
+    mz_min=float,
+    mz_max=float,
+    mz_dist=str2dist,
+    rt_min=float,
+    rt_max=float,
+    rt_dist=str2dist,
+    seed=int
+)
+
+def draw(rs, n, lo, hi, dist):
+    """n values between lo and hi, uniformly or normally distributed
+    around the middle"""
+    if dist == 'normal':
+        return np.clip(rs.normal((lo + hi) / 2., (hi - lo) / 6., n), lo, hi)
+    return rs.uniform(lo, hi, n)
+
+def exp_name(n):
+    # list_exp_files takes the name up to the first _ and lowercases it
+    return 'syn%03d' % n
+
+def write_experiments(dir, spec=None):
+    """write the data and metadata files of the experiments spec
+    describes (see default_spec) to dir. returns their names and file
+    names as cli.list_exp_files does"""
+    if spec is None:
+        spec = default_spec()
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    rs = np.random.RandomState(spec['seed'])
+    n_features = spec['features']
+    n_shared = int(round(n_features * spec['shared']))
+    pool_mz = draw(rs, n_features, spec['mz_min'], spec['mz_max'], spec['mz_dist'])
+    pool_rt = draw(rs, n_features, spec['rt_min'], spec['rt_max'], spec['rt_dist'])
+    result = []
+    for n in range(spec['experiments']):
+        name = exp_name(n)
+        samples = ['%s_s%03d' % (name, k) for k in range(spec['samples'])]
+        n_controls = int(round(len(samples) * spec['controls']))
+        metadata = '%s_metadata.csv' % name
+        with open(os.path.join(dir, metadata), 'w') as f:
+            w = csv.writer(f)
+            attrs = ['attr%d' % (a + 1) for a in range(spec['attrs'])]
+            w.writerow([FILE_NAME, CONTROL] + attrs)
+            for k, sample in enumerate(samples):
+                control = 1 if k < n_controls else 0
+                w.writerow([sample, control] + ['v%d' % rs.randint(3) for a in attrs])
+        # shared compounds first, then features of this experiment's own
+        shared = rs.choice(n_features, n_shared, replace=False)
+        mz = np.concatenate([pool_mz[shared] * (1 + rs.normal(0, MZ_SCATTER, n_shared) / 1e6),
+                             draw(rs, n_features - n_shared, spec['mz_min'], spec['mz_max'], spec['mz_dist'])])
+        rt = np.concatenate([pool_rt[shared] + rs.normal(0, RT_SCATTER, n_shared),
+                             draw(rs, n_features - n_shared, spec['rt_min'], spec['rt_max'], spec['rt_dist'])])
+        intensities = rs.lognormal(10, 2, (n_features, len(samples)))
+        intensities[rs.uniform(size=intensities.shape) < spec['zeros']] = 0
+        data = '%s_data.csv' % name
+        with open(os.path.join(dir, data), 'w') as f:
+            w = csv.writer(f)
+            fields = sorted(COMMON_FIELDS)
+            w.writerow(fields + samples)
+            for i in range(n_features):
+                d = {
+                    'mz': mz[i],
+                    'mzmin': mz[i] * (1 - 1e-6),
+                    'mzmax': mz[i] * (1 + 1e-6),
+                    'rt': rt[i],
+                    'rtmin': rt[i] - 2,
+                    'rtmax': rt[i] + 2,
+                    'isotopes': '',
+                    'adduct': '',
+                    'pcgroup': i // 10 + 1,
+                    'withMS2': int(rs.uniform() < WITH_MS2),
+                    'annotated': ''
+                }
+                w.writerow([format_value(d[k]) for k in fields] + [format_value(v) for v in intensities[i].tolist()])
+        result.append({
+            'name': name,
+            'data': data,
+            'metadata': metadata
+        })
+    return result
@@ -51,3 +51,37 @@ def resultproxy2asciitable(r,empty_message='No rows'):
         rows.append(dict(r.items()))
     for line in asciitable(rows,cols,empty_message):
         print line
+
+# m/z and retention time windows as closed ranges, so that range
+# predicates can be answered from an index. the bounds are widened
+# very slightly to absorb floating point rounding; callers keep the
+# exact ppm/rt test as well
+
+EPSILON=1e-12
+
+def ppm_bounds(mz,ppm_diff):
+    """range of m such that 1e6 * abs(m - mz) <= ppm_diff * m"""
+    lo = mz * 1e6 / (1e6 + ppm_diff)
+    hi = mz * 1e6 / (1e6 - ppm_diff)
+    return lo * (1 - EPSILON), hi * (1 + EPSILON)
+
+def ppm_window(mz,ppm_diff):
+    """range of m such that 1e6 * abs(m - mz) <= ppm_diff * mz"""
+    d = abs(mz) * ppm_diff / 1e6
+    return (mz - d) * (1 - EPSILON), (mz + d) * (1 + EPSILON)
+
+def rt_window(rt,rt_diff):
+    """range of r such that abs(r - rt) <= rt_diff"""
+    d = rt_diff + abs(rt) * EPSILON
+    return rt - d, rt + d
+
+def format_value(v):
+    """format a value for CSV output. floats are written with as many
+    digits as it takes to read them back exactly, which str does not"""
+    if isinstance(v, float):
+        return repr(v)
+    return str(v)
+
+def console_log(o):
+    """so I can mix old and new-style print functions"""
+    print str(o)